@@ -1,15 +1,50 @@
-from flask import Flask, jsonify, request, send_file, render_template_string
+import time
+_import_started = time.perf_counter()
+
+from flask import Flask, Request, Response, g, jsonify, request, render_template_string, abort, make_response, redirect
 import redis
 import psycopg2
-import boto3
-from botocore.exceptions import ClientError
+import psycopg2.extensions
+import psycopg2.pool
+try:
+    from PIL import Image, ImageOps, features as PIL_features
+except ImportError:  # Previews fall back to the original image
+    Image = None
+try:
+    import zstandard
+except ImportError:  # Compression falls back to gzip
+    zstandard = None
 import os
-import time
+import sys
 import logging
-from typing import Dict, Any
+import logging.handlers
+import threading
+import queue
+import concurrent.futures
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import dump_options_header, http_date, parse_date, quote_etag, unquote_etag
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import ClosingIterator
 import uuid
+import json
+import hashlib
+import random
 from io import BytesIO
+import base64
+import mimetypes
+import unicodedata
+import zipfile
+import zlib
+import math
+import importlib.util
+import bisect
+from array import array
+from datetime import datetime, timezone
+from urllib.parse import quote
 
 # Configure logging
 logging.basicConfig(
@@ -31,8 +66,77 @@ class Config:
         self.pg_db = os.getenv('POSTGRES_DB', 'postgres')
         self.pg_password = os.getenv('POSTGRES_PASSWORD', '')
         self.app_port = int(os.getenv('APP_PORT', '80'))
+
+        # Serving: 'gunicorn' (pre-fork, production) or 'development' (Werkzeug)
+        self.server_mode = os.getenv('SERVER_MODE', 'gunicorn').lower()
+        self.web_workers = int(os.getenv('WEB_WORKERS', str(max(2, os.cpu_count() or 1))))
+        self.web_threads = int(os.getenv('WEB_THREADS', '8'))
+        self.web_timeout = int(os.getenv('WEB_TIMEOUT', '120'))
+        self.web_graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+        self.web_keepalive = int(os.getenv('WEB_KEEPALIVE', '5'))
+        self.web_max_requests = int(os.getenv('WEB_MAX_REQUESTS', '0'))
+        self.web_max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER', '0'))
+
+        # Admission control (per worker): transfers may use every thread but the
+        # ones reserved for health checks, and each transfer class has its own limits
+        self.health_reserved_threads = int(os.getenv('HEALTH_RESERVED_THREADS', '2'))
+        self.upload_max_concurrent = int(os.getenv('UPLOAD_MAX_CONCURRENT', '4'))
+        self.upload_max_inflight_bytes = int(os.getenv('UPLOAD_MAX_INFLIGHT_BYTES', str(2 * 1024 ** 3)))
+        self.download_max_concurrent = int(os.getenv('DOWNLOAD_MAX_CONCURRENT', '6'))
+        self.admission_queue_depth = int(os.getenv('ADMISSION_QUEUE_DEPTH', '4'))
+        self.admission_queue_timeout = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '2'))
+        self.admission_retry_after = int(os.getenv('ADMISSION_RETRY_AFTER', '2'))
+        self.max_upload_bytes = int(os.getenv('MAX_UPLOAD_BYTES', str(5 * 1024 ** 3)))
+        self.max_request_bytes = int(os.getenv('MAX_REQUEST_BYTES', str(1024 ** 2)))
         self.connection_timeout = int(os.getenv('CONNECTION_TIMEOUT', '5'))
 
+        # Connection pool sizing
+        self.redis_max_connections = int(os.getenv('REDIS_MAX_CONNECTIONS', '20'))
+        self.redis_health_check_interval = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+        self.pg_pool_min = int(os.getenv('PG_POOL_MIN', '1'))
+        self.pg_pool_max = int(os.getenv('PG_POOL_MAX', '10'))
+        self.pg_pool_max_idle = int(os.getenv('PG_POOL_MAX_IDLE', '300'))
+        self.pg_pool_max_lifetime = int(os.getenv('PG_POOL_MAX_LIFETIME', '3600'))
+        self.pg_pool_validate_interval = int(os.getenv('PG_POOL_VALIDATE_INTERVAL', '30'))
+
+        # Health check fan-out
+        self.health_max_workers = int(os.getenv('HEALTH_MAX_WORKERS', '8'))
+        self.health_check_timeout = float(os.getenv('HEALTH_CHECK_TIMEOUT', '3'))
+        self.health_deadline = float(os.getenv('HEALTH_DEADLINE', '4'))
+
+        # Background prober: per-service refresh intervals (seconds)
+        probe_interval = float(os.getenv('PROBE_INTERVAL', '10'))
+        self.probe_intervals = {
+            name: float(os.getenv(f'PROBE_INTERVAL_{name.upper()}', probe_interval))
+            for name in ('redis', 'postgres', 's3')
+        }
+        self.probe_max_staleness = float(os.getenv('PROBE_MAX_STALENESS', '60'))
+        self.probe_levels = [level.strip() for level in
+                             os.getenv('PROBE_LEVELS', 'readiness').split(',') if level.strip()]
+        self.deep_probe_interval = float(os.getenv('DEEP_PROBE_INTERVAL', '300'))
+        self.probe_retry_interval = float(os.getenv('PROBE_RETRY_INTERVAL', '1'))
+
+        # Probe history: raw samples kept per service, and how many 1m / 1h rollups
+        self.health_history_samples = int(os.getenv('HEALTH_HISTORY_SAMPLES', '1024'))
+        self.health_history_minutes = int(os.getenv('HEALTH_HISTORY_MINUTES', '180'))
+        self.health_history_hours = int(os.getenv('HEALTH_HISTORY_HOURS', '168'))
+
+        # Circuit breakers: consecutive failures that open a backend's circuit, and
+        # how long it stays open (doubling after each failed trial, up to the max)
+        self.circuit_breaker_enabled = os.getenv('CIRCUIT_BREAKER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+        failure_threshold = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+        self.circuit_failure_thresholds = {
+            name: int(os.getenv(f'CIRCUIT_FAILURE_THRESHOLD_{name.upper()}', failure_threshold))
+            for name in ('redis', 'postgres', 's3')
+        }
+        self.circuit_reset_timeout = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '5'))
+        self.circuit_max_reset_timeout = float(os.getenv('CIRCUIT_MAX_RESET_TIMEOUT', '60'))
+        self.s3_credentials_retry_interval = float(os.getenv('S3_CREDENTIALS_RETRY_INTERVAL', '5'))
+
+        # Startup: serving never waits on backends unless a readiness timeout is set
+        self.startup_readiness_timeout = float(os.getenv('STARTUP_READINESS_TIMEOUT', '0'))
+        self.import_time_budget_ms = float(os.getenv('IMPORT_TIME_BUDGET_MS', '1000'))
+
         # S3/Garage configuration - initialize first
         self.s3_endpoint = os.getenv('GARAGE_S3_ENDPOINT', 'http://127.0.0.1:3900')
         self.s3_region = os.getenv('GARAGE_S3_REGION', 'garage')
@@ -40,6 +144,89 @@ class Config:
         self.aws_secret_key = os.getenv('AWS_SECRET_ACCESS_KEY')
         self.s3_bucket = os.getenv('S3_BUCKET', 'default-bucket')
         self.credentials_file = '/data/garage/credentials.env'
+        self.s3_public_endpoint = os.getenv('S3_PUBLIC_ENDPOINT', self.s3_endpoint)
+        self.s3_presigned_mode = os.getenv('S3_PRESIGNED_MODE', 'false').lower() in ('1', 'true', 'yes')
+        self.s3_presign_expiry = int(os.getenv('S3_PRESIGN_EXPIRY', '300'))
+        self.s3_stream_chunk_size = int(os.getenv('S3_STREAM_CHUNK_SIZE', str(64 * 1024)))
+        self.s3_part_size = int(os.getenv('S3_PART_SIZE', str(8 * 1024 * 1024)))
+        self.s3_upload_concurrency = int(os.getenv('S3_UPLOAD_CONCURRENCY', '4'))
+        self.s3_upload_max_workers = int(os.getenv('S3_UPLOAD_MAX_WORKERS', '16'))
+        # S3 transport: 0 sizes the connection pool from every thread that can call S3
+        self.s3_max_pool_connections = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '0'))
+        self.s3_connect_timeout = float(os.getenv('S3_CONNECT_TIMEOUT', os.getenv('CONNECTION_TIMEOUT', '5')))
+        self.s3_read_timeout = float(os.getenv('S3_READ_TIMEOUT', '60'))
+        self.s3_retry_mode = os.getenv('S3_RETRY_MODE', 'adaptive')
+        self.s3_max_attempts = int(os.getenv('S3_MAX_ATTEMPTS', '3'))
+        self.s3_tcp_keepalive = os.getenv('S3_TCP_KEEPALIVE', 'true').lower() in ('1', 'true', 'yes')
+        self.s3_stale_upload_age = int(os.getenv('S3_STALE_UPLOAD_AGE', '86400'))
+        self.s3_stale_upload_cleanup_interval = int(os.getenv('S3_STALE_UPLOAD_CLEANUP_INTERVAL', '3600'))
+
+        # Batch uploads and archive downloads
+        self.batch_upload_max_files = int(os.getenv('BATCH_UPLOAD_MAX_FILES', '100'))
+        self.batch_upload_concurrency = int(os.getenv('BATCH_UPLOAD_CONCURRENCY', '4'))
+        self.batch_upload_max_workers = int(os.getenv('BATCH_UPLOAD_MAX_WORKERS', '8'))
+        self.archive_max_keys = int(os.getenv('ARCHIVE_MAX_KEYS', '1000'))
+
+        # Preview derivatives: name -> longest edge in pixels
+        self.thumbnail_sizes = {
+            name.strip(): int(pixels)
+            for name, pixels in (item.split(':') for item in
+                                 os.getenv('THUMBNAIL_SIZES', 'small:160,medium:480,large:1280').split(','))
+        }
+        self.thumbnail_format = os.getenv('THUMBNAIL_FORMAT', 'webp').lower()
+        self.thumbnail_quality = int(os.getenv('THUMBNAIL_QUALITY', '80'))
+        self.thumbnail_workers = int(os.getenv('THUMBNAIL_WORKERS', '1'))
+        self.thumbnail_wait = float(os.getenv('THUMBNAIL_WAIT', '15'))
+        self.thumbnail_max_source_bytes = int(os.getenv('THUMBNAIL_MAX_SOURCE_BYTES', str(64 * 1024 * 1024)))
+
+        # Hot object cache (Redis)
+        self.object_cache_enabled = os.getenv('OBJECT_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+        self.object_cache_max_object_bytes = int(os.getenv('OBJECT_CACHE_MAX_OBJECT_BYTES', str(256 * 1024)))
+        self.object_cache_budget_bytes = int(os.getenv('OBJECT_CACHE_BUDGET_BYTES', str(64 * 1024 * 1024)))
+        self.object_cache_ttl = int(os.getenv('OBJECT_CACHE_TTL', '3600'))
+
+        # Browser/CDN caching of downloads; uploaded keys are unique so files never change
+        self.file_cache_max_age = int(os.getenv('FILE_CACHE_MAX_AGE', '31536000'))
+        self.preview_cache_max_age = int(os.getenv('PREVIEW_CACHE_MAX_AGE', '86400'))
+
+        # Compression: compressible uploads are stored encoded, JSON responses compressed on the fly
+        self.compression_enabled = os.getenv('COMPRESSION_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        self.compression_encoding = os.getenv('COMPRESSION_ENCODING', 'zstd').lower()
+        self.compression_types = [
+            t.strip().lower() for t in os.getenv(
+                'COMPRESSION_TYPES',
+                'text/,application/json,application/xml,application/javascript,'
+                'application/x-ndjson,application/csv,image/svg+xml'
+            ).split(',') if t.strip()
+        ]
+        self.gzip_level = int(os.getenv('GZIP_LEVEL', '6'))
+        self.zstd_level = int(os.getenv('ZSTD_LEVEL', '3'))
+        self.json_compression_min_bytes = int(os.getenv('JSON_COMPRESSION_MIN_BYTES', '1024'))
+
+        # File metadata index
+        self.file_list_limit = int(os.getenv('FILE_LIST_LIMIT', '100'))
+        self.file_list_max_limit = int(os.getenv('FILE_LIST_MAX_LIMIT', '1000'))
+        self.metadata_reconcile_interval = int(os.getenv('METADATA_RECONCILE_INTERVAL', '3600'))
+
+        # Content-addressed deduplication of uploads
+        self.dedup_enabled = os.getenv('DEDUP_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        self.dedup_lock_ttl = int(os.getenv('DEDUP_LOCK_TTL', '60'))
+        self.dedup_lock_wait = float(os.getenv('DEDUP_LOCK_WAIT', '120'))
+
+        # Prometheus metrics; the directory is shared by all gunicorn workers
+        self.metrics_enabled = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+        self.metrics_multiproc_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus-metrics')
+        self.metrics_sample_interval = float(os.getenv('METRICS_SAMPLE_INTERVAL', '5'))
+
+        # Per-request profiling, opted into with a request header
+        self.profiling_enabled = os.getenv('PROFILING_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        self.profiling_header = os.getenv('PROFILING_HEADER', 'X-Profile')
+        self.profiling_ttl = int(os.getenv('PROFILING_TTL', '600'))
+        self.profiling_keep = int(os.getenv('PROFILING_KEEP', '100'))
+        self.profiling_sample_interval = float(os.getenv('PROFILING_SAMPLE_INTERVAL', '0.005'))
+        self.profiling_log_file = os.getenv('PROFILING_LOG_FILE', '')
+        self.profiling_log_max_bytes = int(os.getenv('PROFILING_LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+        self.profiling_log_backups = int(os.getenv('PROFILING_LOG_BACKUPS', '3'))
 
         # Load credentials from file if environment variables are not set
         self._load_s3_credentials()
@@ -67,52 +254,962 @@ class Config:
 
 config = Config()
 
-def load_credentials_from_file():
-    """Load S3 credentials from file if available"""
-    credentials_file = '/data/garage/credentials.env'
-    if os.path.exists(credentials_file):
-        try:
-            with open(credentials_file, 'r') as f:
-                for line in f:
-                    if '=' in line:
-                        key, value = line.strip().split('=', 1)
-                        os.environ[key] = value
+# Metrics. prometheus_client picks its storage backend when it is imported, so
+# under a pre-fork server the shared directory must be set before the import.
+if config.metrics_enabled and config.server_mode == 'gunicorn':
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = config.metrics_multiproc_dir
+    os.makedirs(config.metrics_multiproc_dir, exist_ok=True)
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:  # /metrics reports itself unavailable
+    prometheus_client = None
+
+metrics_enabled = config.metrics_enabled and prometheus_client is not None
+
+if metrics_enabled:
+    BACKEND_CALL_SECONDS = prometheus_client.Histogram(
+        'app_backend_call_duration_seconds',
+        'Duration of Redis commands, PostgreSQL queries and S3 API calls',
+        ['backend', 'operation', 'status'],
+        buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+    )
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        'app_request_duration_seconds',
+        'Time until response headers are sent, by route',
+        ['method', 'route', 'status'],
+        buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+    )
+    REQUESTS_IN_FLIGHT = prometheus_client.Gauge(
+        'app_requests_in_flight',
+        'Requests currently being handled',
+        multiprocess_mode='livesum'
+    )
+    TRANSFER_BYTES = prometheus_client.Counter(
+        'app_transfer_bytes',
+        'File bytes uploaded to and downloaded from the app',
+        ['direction']
+    )
+    TRANSFER_THROUGHPUT = prometheus_client.Histogram(
+        'app_transfer_throughput_bytes_per_second',
+        'Throughput of completed uploads and downloads',
+        ['direction'],
+        buckets=tuple(64 * 1024 * 4 ** n for n in range(8))
+    )
+    POOL_CONNECTIONS = prometheus_client.Gauge(
+        'app_pool_connections',
+        'Backend connections by pool and state',
+        ['pool', 'state'],
+        multiprocess_mode='livesum'
+    )
+    CIRCUIT_STATE = prometheus_client.Gauge(
+        'app_circuit_state',
+        'Circuit breaker state by backend (0 closed, 1 half-open, 2 open), worst worker',
+        ['backend'],
+        multiprocess_mode='livemax'
+    )
+    ADMISSION_IN_FLIGHT = prometheus_client.Gauge(
+        'app_admission_in_flight',
+        'Admitted transfer requests by route class',
+        ['route_class'],
+        multiprocess_mode='livesum'
+    )
+    ADMISSION_REJECTED = prometheus_client.Counter(
+        'app_admission_rejected',
+        'Transfer requests turned away by admission control',
+        ['route_class', 'status']
+    )
+    CIRCUIT_REJECTED = prometheus_client.Counter(
+        'app_circuit_rejected',
+        'Backend calls failed fast because the circuit was open',
+        ['backend']
+    )
+
+# Request profiling: spans of the current profiled request (None when not profiling)
+current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar('current_span', default=None)
+
+class Span:
+    """One timed step of a profiled request"""
+
+    __slots__ = ('name', 'detail', 'started', 'duration', 'children')
+
+    def __init__(self, name: str, detail: Optional[str] = None, started: Optional[float] = None):
+        self.name = name
+        self.detail = detail
+        self.started = time.perf_counter() if started is None else started
+        self.duration = None
+        self.children = []
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        entry = {
+            "name": self.name,
+            "start_ms": round((self.started - origin) * 1000, 3),
+            "duration_ms": round((self.duration or 0) * 1000, 3)
+        }
+        if self.detail:
+            entry["detail"] = self.detail
+        if self.children:
+            entry["children"] = [child.to_dict(origin) for child in self.children]
+        return entry
+
+@contextmanager
+def span(name: str, detail: Optional[str] = None) -> Iterator[None]:
+    """Time a block as a child of the current span; a no-op unless profiling"""
+    parent = current_span.get()
+    if parent is None:
+        yield
+        return
+    child = Span(name, detail)
+    parent.children.append(child)
+    token = current_span.set(child)
+    try:
+        yield
+    finally:
+        child.finish()
+        current_span.reset(token)
+
+def add_span(parent: Span, name: str, detail: Any, started: float, duration: float):
+    """Attach an already finished leaf span (backend calls) to a parent"""
+    child = Span(name, str(detail)[:500] if detail is not None else None, started)
+    child.duration = duration
+    parent.children.append(child)
+
+@contextmanager
+def backend_call(backend: str, operation: str, detail: Any = None) -> Iterator[None]:
+    """Time one call to a backend into the histogram and the request profile"""
+    parent = current_span.get()
+    if not metrics_enabled and parent is None:
+        yield
+        return
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        if metrics_enabled:
+            BACKEND_CALL_SECONDS.labels(backend, operation, status).observe(elapsed)
+        if parent is not None:
+            add_span(parent, f"{backend} {operation}", detail, started, elapsed)
+
+def record_transfer(direction: str, size: int, seconds: float):
+    """Count transferred file bytes and the throughput of a finished transfer"""
+    if not metrics_enabled:
+        return
+    TRANSFER_BYTES.labels(direction).inc(size)
+    if size and seconds > 0:
+        TRANSFER_THROUGHPUT.labels(direction).observe(size / seconds)
+
+def _s3_call_params(params, context, **kwargs):
+    # The only hook that sees the API parameters, before they are serialized
+    if current_span.get() is not None:
+        context['trace_key'] = params.get('Key')
+
+def _s3_call_started(context, **kwargs):
+    context['metrics_started'] = time.perf_counter()
+    context['trace_parent'] = current_span.get()
+
+def _s3_call_finished(event_name: str, context, http_response=None, **kwargs):
+    # Streaming bodies are read later, so get_object is timed to its headers
+    started = context.get('metrics_started')
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    operation = event_name.rsplit('.', 1)[-1]
+    ok = http_response is not None and http_response.status_code < 400
+    if metrics_enabled:
+        BACKEND_CALL_SECONDS.labels("s3", operation, "ok" if ok else "error").observe(elapsed)
+    parent = context.get('trace_parent')
+    if parent is not None:
+        add_span(parent, f"s3 {operation}", context.get('trace_key'), started, elapsed)
+
+def instrument_s3_client(client):
+    """Time every API call a boto3 S3 client makes, retries included, behind the S3 circuit breaker"""
+    client.meta.events.register('before-call.s3', _s3_circuit_check)
+    client.meta.events.register('after-call.s3', _s3_circuit_record)
+    client.meta.events.register('after-call-error.s3', _s3_circuit_record)
+    if metrics_enabled or config.profiling_enabled:
+        client.meta.events.register('before-parameter-build.s3', _s3_call_params)
+        client.meta.events.register('before-call.s3', _s3_call_started)
+        client.meta.events.register('after-call.s3', _s3_call_finished)
+        client.meta.events.register('after-call-error.s3', _s3_call_finished)
+    return client
+
+# Circuit breakers - fail fast while a backend is down instead of waiting out
+# connect timeouts on every call
+class CircuitOpenError(Exception):
+    """A call was refused because its backend's circuit is open"""
+
+    def __init__(self, backend: str, retry_after: float):
+        super().__init__(f"{backend} circuit open, retrying in {retry_after:.1f}s")
+        self.backend = backend
+        self.retry_after = retry_after
+
+class RedisCircuitOpen(CircuitOpenError, redis.ConnectionError):
+    pass
+
+class PostgresCircuitOpen(CircuitOpenError, psycopg2.OperationalError):
+    pass
+
+class RedisPoolExhausted(redis.ConnectionError):
+    """No pooled Redis connection freed up in time: local back-pressure, not a Redis outage"""
+
+class CircuitBreaker:
+    """Per-process circuit breaker for one backend
+
+    Closed: calls go through and consecutive failures are counted. Once they
+    reach the threshold the circuit opens and calls fail immediately. After
+    the reset timeout (with jitter) it goes half-open and lets a single trial
+    call through: success closes it, failure reopens it for twice as long,
+    up to the maximum. Only failures that mean the backend is unreachable
+    (connection errors, timeouts, 5xx) count, and only errors the backend
+    itself answered with count as success. Local errors (pool exhaustion,
+    bad arguments) say nothing about the backend and are not recorded.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float,
+                 max_reset_timeout: float, error=CircuitOpenError, failures=(), answered=(),
+                 local=(), enabled: bool = True):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.error = error
+        self.failure_types = failures
+        self.answered_types = answered
+        self.local_types = local
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_for = reset_timeout
+        self.retry_at = 0.0
+        self.trial_started = None
+        self.opened_count = 0
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            log = logger.info if state == self.CLOSED else logger.warning
+            log(f"{self.name} circuit {self.state} -> {state}")
+        self.state = state
+        if metrics_enabled:
+            CIRCUIT_STATE.labels(self.name).set(self.STATE_VALUES[state])
+
+    def _open(self, now: float):
+        self.opened_count += 1
+        self.retry_at = now + self.open_for * random.uniform(0.8, 1.2)
+        self.trial_started = None
+        self._set_state(self.OPEN)
+
+    def available(self) -> bool:
+        """Whether a call would be let through right now, without claiming the trial"""
+        if not self.enabled or self.state == self.CLOSED:
             return True
-        except Exception as e:
-            logger.warning(f"Failed to load credentials from file: {e}")
-    return False
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            return now >= self.retry_at
+        return self.trial_started is None or now - self.trial_started > self.open_for
+
+    def allow(self) -> bool:
+        """Let a call through, claiming the half-open trial if it is due"""
+        if not self.enabled or self.state == self.CLOSED:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and now < self.retry_at:
+                return False
+            # One trial at a time; a trial that never reported back is replaced
+            if self.state == self.HALF_OPEN and self.trial_started is not None \
+                    and now - self.trial_started <= self.open_for:
+                return False
+            self.trial_started = now
+            self._set_state(self.HALF_OPEN)
+            return True
+
+    def check(self):
+        """Raise the backend's CircuitOpenError if the call must fail fast"""
+        if not self.allow():
+            if metrics_enabled:
+                CIRCUIT_REJECTED.labels(self.name).inc()
+            raise self.error(self.name, max(self.retry_at - time.monotonic(), 0))
+
+    def record_success(self):
+        if self.state == self.CLOSED and self.failures == 0:
+            return
+        with self._lock:
+            self.failures = 0
+            self.open_for = self.reset_timeout
+            self.trial_started = None
+            self._set_state(self.CLOSED)
+
+    def release_trial(self):
+        """Give back a claimed half-open trial that produced no verdict"""
+        if self.state != self.HALF_OPEN:
+            return
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.trial_started = None
+
+    def record_failure(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                self.open_for = min(self.open_for * 2, self.max_reset_timeout)
+                self._open(now)
+            elif self.state == self.CLOSED:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self._open(now)
+
+    @contextmanager
+    def guard(self) -> Iterator[None]:
+        """Fail fast if open, and record the outcome of the call in the block"""
+        self.check()
+        try:
+            yield
+        except self.local_types:
+            self.release_trial()
+            raise
+        except self.failure_types:
+            self.record_failure()
+            raise
+        except self.answered_types:
+            self.record_success()  # The backend answered, with an error of our own making
+            raise
+        except BaseException:
+            self.release_trial()
+            raise
+        self.record_success()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """State for /health"""
+        result = {"state": self.state, "failures": self.failures, "opened": self.opened_count}
+        if self.state != self.CLOSED:
+            result["retry_in_seconds"] = round(max(self.retry_at - time.monotonic(), 0), 2)
+        return result
+
+    def after_fork(self):
+        """Start closed with a fresh lock in a new worker"""
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_for = self.reset_timeout
+        self.trial_started = None
+
+def _breaker(name: str, error=CircuitOpenError, failures=(), answered=(), local=()) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        failure_threshold=config.circuit_failure_thresholds[name],
+        reset_timeout=config.circuit_reset_timeout,
+        max_reset_timeout=config.circuit_max_reset_timeout,
+        error=error,
+        failures=failures,
+        answered=answered,
+        local=local,
+        enabled=config.circuit_breaker_enabled
+    )
+
+breakers = {
+    "redis": _breaker("redis", RedisCircuitOpen, failures=(redis.ConnectionError, redis.TimeoutError),
+                      answered=(redis.ResponseError,), local=(RedisPoolExhausted,)),
+    # PostgreSQL outcomes are recorded per connect and per query (record_postgres_outcome)
+    "postgres": _breaker("postgres", PostgresCircuitOpen),
+    # S3 outcomes are recorded by botocore hooks rather than guard()
+    "s3": _breaker("s3")
+}
+
+def _s3_circuit_check(**kwargs):
+    breakers["s3"].check()
+
+def _s3_circuit_record(http_response=None, **kwargs):
+    if http_response is None or http_response.status_code >= 500:
+        breakers["s3"].record_failure()
+    else:
+        breakers["s3"].record_success()
+
+def load_credentials_from_file() -> Optional[Dict[str, str]]:
+    """Read the S3 credentials file, or None if it is missing or unreadable"""
+    try:
+        with open(config.credentials_file, 'r') as f:
+            return dict(line.strip().split('=', 1) for line in f if '=' in line)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Failed to load credentials from file: {e}")
+        return None
+
+# boto3/botocore dominate cold-start time, so they are imported on first S3 use
+boto3 = None
+BotoConfig = None
+
+class ClientError(Exception):
+    """Stand-in for botocore's ClientError until botocore is imported"""
+
+def import_boto3():
+    """Import boto3 and botocore, rebinding the module-level names"""
+    global boto3, BotoConfig, ClientError
+    if boto3 is None:
+        import boto3 as _boto3
+        from botocore.config import Config as _BotoConfig
+        from botocore.exceptions import ClientError as _ClientError
+        # Nothing can raise the stand-in: every client is built after this runs
+        ClientError = _ClientError
+        BotoConfig = _BotoConfig
+        boto3 = _boto3
+    return boto3
 
 # Initialize S3 client (will be created when credentials are available)
 s3_client = None
+_s3_client_lock = threading.Lock()
+# Credentials given in the environment are fixed; otherwise the credentials file
+# is watched and the clients rebuilt whenever it changes
+_credentials_from_env = bool(os.getenv('AWS_ACCESS_KEY_ID') and os.getenv('AWS_SECRET_ACCESS_KEY'))
+_credentials_checked_at = None
+_credentials_mtime = None
+
+def s3_pool_size() -> int:
+    """Connections per S3 client: one for every thread that may be talking to S3 at once"""
+    if config.s3_max_pool_connections > 0:
+        return config.s3_max_pool_connections
+    return (config.web_threads + config.s3_upload_max_workers + config.batch_upload_max_workers
+            + config.health_max_workers + config.thumbnail_workers)
+
+def s3_transport_config(**overrides):
+    """botocore settings shared by every S3 client: pool size, timeouts, retries and keep-alive"""
+    import_boto3()
+    settings = {
+        "max_pool_connections": s3_pool_size(),
+        "connect_timeout": config.s3_connect_timeout,
+        "read_timeout": config.s3_read_timeout,
+        "retries": {"mode": config.s3_retry_mode, "total_max_attempts": config.s3_max_attempts},
+        "tcp_keepalive": config.s3_tcp_keepalive
+    }
+    settings.update(overrides)
+    return BotoConfig(**settings)
+
+def credentials_check_due() -> bool:
+    """Whether the credentials file is due another mtime check"""
+    return not _credentials_from_env and (
+        _credentials_checked_at is None or
+        time.monotonic() - _credentials_checked_at >= config.s3_credentials_retry_interval)
+
+def reload_s3_credentials() -> bool:
+    """Re-read the credentials file if its mtime changed; True when the keys changed
+
+    The file is stat()ed at most every S3_CREDENTIALS_RETRY_INTERVAL seconds.
+    Called with _s3_client_lock held.
+    """
+    global _credentials_checked_at, _credentials_mtime
+    if not credentials_check_due():
+        return False
+    _credentials_checked_at = time.monotonic()
+    try:
+        mtime = os.stat(config.credentials_file).st_mtime_ns
+    except OSError:
+        return False
+    if mtime == _credentials_mtime:
+        return False
+    values = load_credentials_from_file()
+    if values is None:
+        return False
+    _credentials_mtime = mtime
+    access_key = values.get('AWS_ACCESS_KEY_ID')
+    secret_key = values.get('AWS_SECRET_ACCESS_KEY')
+    if not access_key or not secret_key or (access_key, secret_key) == (config.aws_access_key, config.aws_secret_key):
+        return False
+    config.aws_access_key, config.aws_secret_key = access_key, secret_key
+    return True
 
 def get_s3_client():
-    """Get or create S3 client with current credentials"""
-    global s3_client
+    """Get or create S3 client with current credentials
+
+    Returns None while credentials are missing or the S3 circuit is open, so
+    callers answer 503 straight away. The client is created once per process
+    under a lock and shared by every thread; a changed credentials file
+    replaces it, and requests still holding the old client finish with it.
+    """
+    global s3_client, presign_client
+
+    if not breakers["s3"].available():
+        return None
 
-    # Load credentials if not already loaded
-    if not config.aws_access_key or not config.aws_secret_key:
-        load_credentials_from_file()
-        config.aws_access_key = os.getenv('AWS_ACCESS_KEY_ID')
-        config.aws_secret_key = os.getenv('AWS_SECRET_ACCESS_KEY')
+    client = s3_client
+    if client is not None and not credentials_check_due():
+        return client
 
-    if config.aws_access_key and config.aws_secret_key:
+    with _s3_client_lock:
+        if reload_s3_credentials() and s3_client is not None:
+            logger.info(f"S3 credentials file changed, reconnecting with key: {config.aws_access_key}")
+            s3_client = None
+            presign_client = None
         if s3_client is None:
+            if not config.aws_access_key or not config.aws_secret_key:
+                logger.warning("S3 credentials not available")
+                return None
             try:
-                s3_client = boto3.client(
+                # A session per client: the default session is not safe to share between threads
+                s3_client = instrument_s3_client(import_boto3().session.Session().client(
                     's3',
                     endpoint_url=config.s3_endpoint,
                     aws_access_key_id=config.aws_access_key,
                     aws_secret_access_key=config.aws_secret_key,
-                    region_name=config.s3_region
-                )
-                logger.info(f"S3 client initialized with key: {config.aws_access_key}")
+                    region_name=config.s3_region,
+                    config=s3_transport_config()
+                ))
+                logger.info(f"S3 client initialized with key: {config.aws_access_key} "
+                            f"({s3_pool_size()} pooled connections)")
             except Exception as e:
                 logger.error(f"Failed to initialize S3 client: {e}")
                 return None
         return s3_client
-    else:
-        logger.warning("S3 credentials not available")
+
+# Client used only to sign URLs handed out to browsers, so it targets the public endpoint
+presign_client = None
+
+def get_presign_client():
+    """Get or create the client that signs presigned URLs"""
+    global presign_client
+
+    if get_s3_client() is None:
         return None
+    with _s3_client_lock:
+        if presign_client is None:
+            presign_client = import_boto3().session.Session().client(
+                's3',
+                endpoint_url=config.s3_public_endpoint,
+                aws_access_key_id=config.aws_access_key,
+                aws_secret_access_key=config.aws_secret_key,
+                region_name=config.s3_region,
+                config=BotoConfig(signature_version='s3v4', s3={'addressing_style': 'path'})
+            )
+        return presign_client
+
+# Shared connection layer - reused by the health checks and data paths
+class TrackedConnectionPool(redis.BlockingConnectionPool):
+    """BlockingConnectionPool that keeps its own count of checked-out connections
+
+    The pool's queue also holds placeholders for connections never made, so
+    the pool metrics count checkouts here instead of reading its internals.
+    """
+
+    def reset(self):
+        super().reset()
+        self._tracking_lock = threading.Lock()
+        self._made = []  # Every connection this pool created
+        self._checked_out = set()
+
+    def make_connection(self):
+        connection = super().make_connection()
+        with self._tracking_lock:
+            self._made.append(connection)
+        return connection
+
+    def get_connection(self, *args, **kwargs):
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except redis.ConnectionError as e:
+            # redis-py raises the same ConnectionError when no pooled connection frees up
+            if isinstance(e.__context__, queue.Empty):
+                raise RedisPoolExhausted(str(e)) from None
+            raise
+        with self._tracking_lock:
+            self._checked_out.add(connection)
+        return connection
+
+    def release(self, connection):
+        with self._tracking_lock:
+            self._checked_out.discard(connection)
+        super().release(connection)
+
+    def usage(self) -> Tuple[int, int]:
+        """(in use, idle) connections; idle ones must hold an open socket"""
+        with self._tracking_lock:
+            in_use = len(self._checked_out)
+            idle = sum(1 for connection in self._made
+                       if connection not in self._checked_out and connection._sock is not None)
+        return in_use, idle
+
+def _redis_pool(decode_responses: bool, socket_timeout: Optional[float] = None,
+                max_connections: Optional[int] = None) -> TrackedConnectionPool:
+    return TrackedConnectionPool(
+        host=config.redis_host,
+        port=config.redis_port,
+        socket_connect_timeout=config.connection_timeout,
+        socket_timeout=socket_timeout or config.connection_timeout,
+        health_check_interval=config.redis_health_check_interval,
+        max_connections=max_connections or config.redis_max_connections,
+        timeout=config.connection_timeout,
+        decode_responses=decode_responses
+    )
+
+redis_pool = _redis_pool(decode_responses=True)
+redis_binary_pool = _redis_pool(decode_responses=False)  # For raw object bytes
+
+# Blocking queue reads (BRPOP) wait up to QUEUE_POLL_TIMEOUT for a job, so they get
+# their own connections with a socket timeout beyond that wait
+QUEUE_POLL_TIMEOUT = 5
+redis_blocking_pool = _redis_pool(decode_responses=True,
+                                  socket_timeout=QUEUE_POLL_TIMEOUT + config.connection_timeout,
+                                  max_connections=max(config.thumbnail_workers, 1))
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """Pipeline timing each round trip as a single backend call"""
+
+    def execute(self, raise_on_error: bool = True):
+        with backend_call("redis", "MULTI" if self.transaction else "PIPELINE"), breakers["redis"].guard():
+            return super().execute(raise_on_error)
+
+class InstrumentedRedis(redis.Redis):
+    """Redis client timing every command it sends, behind the Redis circuit breaker"""
+
+    def execute_command(self, *args, **options):
+        command = str(args[0]).upper()
+        detail = None
+        if current_span.get() is not None:
+            # The key, not the script body, is what identifies an EVAL
+            detail = args[3] if command == "EVAL" and len(args) > 3 else args[1] if len(args) > 1 else None
+        with backend_call("redis", command, detail), breakers["redis"].guard():
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+def get_redis(binary: bool = False) -> redis.Redis:
+    """Get a Redis client backed by the shared connection pool"""
+    return InstrumentedRedis(connection_pool=redis_binary_pool if binary else redis_pool)
+
+_RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+def acquire_lock(name: str, ttl: int) -> Optional[str]:
+    """Take a cross-process Redis lock, returning its token or None if held"""
+    token = uuid.uuid4().hex
+    if get_redis().set(f"lock:{name}", token, nx=True, ex=ttl):
+        return token
+    return None
+
+def release_lock(name: str, token: str):
+    """Release a lock, but only if we still own it"""
+    get_redis().eval(_RELEASE_LOCK, 1, f"lock:{name}", token)
+
+_EXTEND_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+def extend_lock(name: str, token: str, ttl: int) -> bool:
+    """Push a lock's expiry ttl seconds out, but only if we still own it"""
+    return bool(get_redis().eval(_EXTEND_LOCK, 1, f"lock:{name}", token, ttl))
+
+@contextmanager
+def lock_held(name: str, token: str, ttl: int) -> Iterator[None]:
+    """Keep an acquired lock alive for as long as the block runs, then release it
+
+    The lock is extended every ttl/3 seconds, so ttl only bounds how long a
+    crashed holder blocks everyone else, not how long the work may take.
+    """
+    done = threading.Event()
+
+    def keep_alive():
+        while not done.wait(ttl / 3):
+            try:
+                if not extend_lock(name, token, ttl):
+                    logger.warning(f"Lost lock {name} while holding it")
+                    return
+            except redis.RedisError as e:
+                logger.warning(f"Failed to extend lock {name}: {e}")
+
+    threading.Thread(target=keep_alive, name=f"lock:{name}", daemon=True).start()
+    try:
+        yield
+    finally:
+        done.set()
+        try:
+            release_lock(name, token)
+        except redis.RedisError as e:
+            # It expires on its own
+            logger.warning(f"Failed to release lock {name}: {e}")
+
+class PeriodicTask:
+    """Run a function every interval seconds on a daemon thread (interval 0 disables it)"""
+
+    def __init__(self, name: str, interval: float, func, initial_delay: float = 0):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.initial_delay = initial_delay
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def ensure_started(self):
+        """Start the thread (again, if we are in a freshly forked worker)"""
+        if self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def after_fork(self):
+        """Drop the thread and lock state inherited from the parent process"""
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _run(self):
+        time.sleep(self.initial_delay)
+        while True:
+            try:
+                self.func()
+            except Exception as e:
+                logger.warning(f"Background task {self.name} failed: {e}")
+            time.sleep(self.interval)
+
+class QueueWorker(PeriodicTask):
+    """Run a one-job function back to back on a daemon thread
+
+    The function blocks while it waits for a job, so there is no pause
+    between calls; interval is only the back-off after a failure.
+    """
+
+    def _run(self):
+        while True:
+            try:
+                self.func()
+            except Exception as e:
+                logger.warning(f"Background task {self.name} failed: {e}")
+                time.sleep(self.interval)
+
+class PostgresPool:
+    """Thread-safe psycopg2 connection pool with validation and idle recycling"""
+
+    def __init__(self, minconn: int, maxconn: int, max_idle: int, max_lifetime: int,
+                 validate_interval: int, breaker: CircuitBreaker, **conn_params):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.validate_interval = validate_interval
+        self.conn_params = conn_params
+        self.breaker = breaker
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._idle = []  # LIFO stack of (conn, created_at, last_used)
+        self._created = {}  # id(conn) -> created_at
+
+    def _connect(self):
+        try:
+            conn = psycopg2.connect(**self.conn_params)
+        except psycopg2.OperationalError:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        conn.autocommit = True
+        self._created[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        self._created.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_usable(self, conn, last_used: float) -> bool:
+        """Validate a pooled connection before handing it out"""
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if now - self._created.get(id(conn), now) > self.max_lifetime:
+            return False
+        if now - last_used > self.max_idle:
+            return False
+        if now - last_used > self.validate_interval:
+            # Only pay a round trip for connections that sat idle a while
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+            except psycopg2.Error:
+                return False
+        return True
+
+    def getconn(self):
+        """Check out a validated connection, opening one if none are idle
+
+        Fails fast while the circuit is open. Waiting for a free slot is local
+        back-pressure, so running out of them leaves the circuit alone.
+        """
+        self.breaker.check()
+        if not self._slots.acquire(timeout=config.connection_timeout):
+            self.breaker.release_trial()
+            raise psycopg2.pool.PoolError("PostgreSQL connection pool exhausted")
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, _, last_used = self._idle.pop()
+                if self._is_usable(conn, last_used):
+                    return conn
+                self._discard(conn)
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def prewarm(self):
+        """Open idle connections up to minconn so the first queries skip the handshake"""
+        while True:
+            with self._lock:
+                if len(self._created) >= self.minconn:
+                    return
+            try:
+                self.breaker.check()
+                conn = self._connect()
+            except (CircuitOpenError, psycopg2.OperationalError) as e:
+                logger.warning(f"Could not pre-warm the PostgreSQL pool: {e}")
+                return
+            with self._lock:
+                self._idle.append((conn, self._created[id(conn)], time.monotonic()))
+
+    def putconn(self, conn, close: bool = False):
+        """Return a connection to the pool, recycling broken or surplus ones"""
+        try:
+            if not close and not conn.closed:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                conn.autocommit = True
+        except psycopg2.Error:
+            close = True
+
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            if close or conn.closed:
+                expired.append(conn)
+            else:
+                self._idle.append((conn, self._created.get(id(conn), now), now))
+            # Recycle connections idle for too long, keeping minconn warm
+            while len(self._idle) > self.minconn and now - self._idle[0][2] > self.max_idle:
+                expired.append(self._idle.pop(0)[0])
+        for stale in expired:
+            self._discard(stale)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        """Context manager yielding a pooled connection, failing fast while the circuit is open"""
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            idle = len(self._idle)
+        return {"open": len(self._created), "idle": idle, "max": self.maxconn}
+
+    def reset(self):
+        """Forget connections inherited across fork() in a new worker"""
+        # Keep them referenced: closing (or garbage collecting) them here would
+        # terminate sessions that still belong to the parent process
+        self._orphaned = [conn for conn, _, _ in self._idle]
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._idle = []
+        self._created = {}
+
+    def closeall(self):
+        """Close every idle connection (checked-out ones close on return)"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+@contextmanager
+def record_postgres_outcome(conn) -> Iterator[None]:
+    """Feed one query's outcome to the PostgreSQL circuit breaker
+
+    Only an error that cost us the connection means the server is gone; an
+    error the server answered with (a cancelled statement, a constraint
+    violation) is a sign of life.
+    """
+    breaker = breakers["postgres"]
+    try:
+        yield
+    except psycopg2.Error:
+        if conn.closed:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    breaker.record_success()
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Cursor timing every query, labelled by its leading SQL keyword"""
+
+    @staticmethod
+    def operation(query) -> str:
+        words = query.split(None, 1) if isinstance(query, str) else None
+        return words[0].upper() if words else "QUERY"
+
+    def execute(self, query, vars=None):
+        with backend_call("postgres", self.operation(query), query), record_postgres_outcome(self.connection):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with backend_call("postgres", self.operation(query), query), record_postgres_outcome(self.connection):
+            return super().executemany(query, vars_list)
+
+def _pg_conn_params() -> Dict[str, Any]:
+    conn_params = {
+        "host": config.pg_host,
+        "port": config.pg_port,
+        "user": config.pg_user,
+        "database": config.pg_db,
+        "connect_timeout": config.connection_timeout,
+        "cursor_factory": InstrumentedCursor
+    }
+    if config.pg_password:
+        conn_params["password"] = config.pg_password
+    return conn_params
+
+pg_pool = PostgresPool(
+    minconn=config.pg_pool_min,
+    maxconn=config.pg_pool_max,
+    max_idle=config.pg_pool_max_idle,
+    max_lifetime=config.pg_pool_max_lifetime,
+    validate_interval=config.pg_pool_validate_interval,
+    breaker=breakers["postgres"],
+    **_pg_conn_params()
+)
 
 # HTML template for file upload interface
 UPLOAD_TEMPLATE = """
@@ -125,6 +1222,7 @@ UPLOAD_TEMPLATE = """
         .upload-area { border: 2px dashed #ccc; padding: 20px; text-align: center; margin: 20px 0; }
         .file-list { margin: 20px 0; }
         .file-item { border: 1px solid #ddd; padding: 10px; margin: 10px 0; border-radius: 5px; }
+        .thumb { max-width: 160px; max-height: 160px; margin: 5px 0; }
         .btn { padding: 10px 20px; background: #007bff; color: white; border: none; border-radius: 5px; cursor: pointer; }
         .btn:hover { background: #0056b3; }
         .status { padding: 10px; margin: 10px 0; border-radius: 5px; }
@@ -162,13 +1260,20 @@ UPLOAD_TEMPLATE = """
             <br>
             Uploaded: {{ file.upload_date }}
             <br>
+            {% if file.is_image %}
+            <img src="/preview/{{ file.key }}{% if file.has_previews %}?size=small{% endif %}" class="thumb" loading="lazy" alt="">
+            <br>
+            {% endif %}
             <a href="/file/{{ file.key }}" class="btn" target="_blank">Download</a>
             {% if file.is_image %}
-            <a href="/preview/{{ file.key }}" class="btn" target="_blank">Preview</a>
+            <a href="/preview/{{ file.key }}{% if file.has_previews %}?size=large{% endif %}" class="btn" target="_blank">Preview</a>
             {% endif %}
         </div>
         {% endfor %}
     </div>
+    {% if next_cursor %}
+    <a href="/?cursor={{ next_cursor }}" class="btn">Older files</a>
+    {% endif %}
 </body>
 </html>
 """
@@ -176,109 +1281,154 @@ UPLOAD_TEMPLATE = """
 @app.route('/')
 def index():
     """Main web interface with file upload"""
-    redis_result = check_redis()
-    postgres_result = check_postgres()
-    s3_result = check_s3()
-
-    files = list_uploaded_files()
-
-    return render_template_string(UPLOAD_TEMPLATE,
-        redis_status="healthy" if redis_result.get("status") == "healthy" else "unhealthy",
-        redis_message=f"Connected to {config.redis_host}:{config.redis_port}",
-        postgres_status="healthy" if postgres_result.get("status") == "healthy" else "unhealthy",
-        postgres_message=f"Connected to {config.pg_host}:{config.pg_port}",
-        s3_status="healthy" if s3_result.get("status") == "healthy" else "unhealthy",
-        s3_message=f"Connected to {config.s3_endpoint}",
-        files=files
-    )
+    with span("health.results"):
+        results = prober.results()
+    with span("files.list"):
+        try:
+            files, next_cursor = list_uploaded_files(cursor=request.args.get('cursor'))
+        except ValueError:
+            files, next_cursor = list_uploaded_files()
+
+    redis_result = results["redis"]
+    postgres_result = results["postgres"]
+    s3_result = results["s3"]
+
+    with span("template.render"):
+        return render_template_string(UPLOAD_TEMPLATE,
+            redis_status="healthy" if redis_result.get("status") == "healthy" else "unhealthy",
+            redis_message=f"Connected to {config.redis_host}:{config.redis_port}",
+            postgres_status="healthy" if postgres_result.get("status") == "healthy" else "unhealthy",
+            postgres_message=f"Connected to {config.pg_host}:{config.pg_port}",
+            s3_status="healthy" if s3_result.get("status") == "healthy" else "unhealthy",
+            s3_message=f"Connected to {config.s3_endpoint}",
+            files=files,
+            next_cursor=next_cursor
+        )
 
 @app.route('/api')
 def api_status() -> Dict[str, Any]:
     """API endpoint with service status"""
-    redis_status = check_redis()
-    postgres_status = check_postgres()
-    s3_status = check_s3()
+    results = with_circuits(prober.results(level=requested_level(), fresh=wants_fresh()))
 
     return jsonify({
         "message": "Nixify Health Check App",
         "version": "1.0.0",
-        "services": {
-            "redis": redis_status,
-            "postgres": postgres_status,
-            "s3": s3_status
-        }
+        "services": results
     })
 
-@app.route('/health')
-def health():
-    """Health check endpoint for monitoring"""
-    redis_result = check_redis()
-    postgres_result = check_postgres()
-    s3_result = check_s3()
+def with_circuits(results: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Health results with each service's circuit breaker state attached"""
+    return {name: dict(result, circuit=breakers[name].snapshot()) for name, result in results.items()}
 
-    redis_healthy = redis_result.get("status") == "healthy"
-    postgres_healthy = postgres_result.get("status") == "healthy"
-    s3_healthy = s3_result.get("status") == "healthy"
+def health_response(level: str):
+    """Aggregate health of every service at the given probe level"""
+    results = with_circuits(prober.results(level=level, fresh=wants_fresh()))
 
-    overall_status = "healthy" if redis_healthy and postgres_healthy and s3_healthy else "unhealthy"
+    all_healthy = all(result.get("status") == "healthy" for result in results.values())
+    overall_status = "healthy" if all_healthy else "unhealthy"
     status_code = 200 if overall_status == "healthy" else 503
 
     return jsonify({
         "status": overall_status,
-        "services": {
-            "redis": redis_result,
-            "postgres": postgres_result,
-            "s3": s3_result
-        },
+        "level": level,
+        "services": results,
         "timestamp": time.time()
     }), status_code
 
-@app.route('/health/redis')
-def health_redis():
-    """Redis-specific health check"""
-    result = check_redis()
-    status_code = 200 if result.get("status") == "healthy" else 503
-    return jsonify(result), status_code
+@app.route('/health')
+def health():
+    """Health check endpoint for monitoring"""
+    return health_response(requested_level())
 
-@app.route('/health/postgres')
-def health_postgres():
-    """PostgreSQL-specific health check"""
-    result = check_postgres()
-    status_code = 200 if result.get("status") == "healthy" else 503
-    return jsonify(result), status_code
+@app.route('/health/live')
+def health_live():
+    """Liveness probe: one cheap round trip per backend"""
+    return health_response("liveness")
+
+@app.route('/health/ready')
+def health_ready():
+    """Readiness probe: read paths of every backend"""
+    return health_response("readiness")
 
-@app.route('/health/s3')
-def health_s3():
-    """S3/Garage-specific health check"""
-    result = check_s3()
+@app.route('/health/<service>')
+def health_service(service):
+    """Service-specific health check (redis, postgres or s3)"""
+    if service not in HEALTH_CHECKS:
+        return jsonify({"error": f"Unknown service: {service}"}), 404
+
+    result = with_circuits(prober.results([service], level=requested_level(), fresh=wants_fresh()))[service]
     status_code = 200 if result.get("status") == "healthy" else 503
     return jsonify(result), status_code
 
-def check_redis() -> Dict[str, Any]:
+@app.route('/health/history')
+def health_history_view():
+    """Probe latency percentiles, error rate and availability over a recent window"""
+    service = request.args.get('service')
+    if service and service not in HEALTH_CHECKS:
+        return jsonify({"error": f"Unknown service: {service}"}), 404
+    level = requested_level()
+    try:
+        window = parse_window(request.args.get('window', '1h'))
+        recent = int(request.args.get('samples', '0'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not 0 < window <= health_history.max_window:
+        return jsonify({"error": f"window must be between 1s and {health_history.max_window}s"}), 400
+
+    names = [service] if service else list(HEALTH_CHECKS)
+    return jsonify({
+        "level": level,
+        "window_seconds": window,
+        "services": {name: health_history.summary(name, level, window, recent=max(recent, 0))
+                     for name in names},
+        "timestamp": time.time()
+    })
+
+WINDOW_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def parse_window(value: str) -> int:
+    """Window length such as 90s, 15m, 6h or 7d (bare numbers are seconds)"""
+    value = value.strip().lower()
+    unit = WINDOW_UNITS.get(value[-1:]) if value else None
+    try:
+        seconds = float(value[:-1] if unit else value) * (unit or 1)
+    except ValueError:
+        raise ValueError(f"Invalid window: {value}") from None
+    if not math.isfinite(seconds):
+        raise ValueError(f"Invalid window: {value}")
+    return int(seconds)
+
+PROBE_LEVELS = ("liveness", "readiness", "deep")
+
+# Facts about the backends that never change while we run, fetched once
+_static_info: Dict[str, Any] = {}
+
+def check_redis(level: str = "readiness") -> Dict[str, Any]:
     """Check Redis connectivity and basic functionality"""
     try:
-        start_time = time.time()
-        r = redis.Redis(
-            host=config.redis_host,
-            port=config.redis_port,
-            socket_connect_timeout=config.connection_timeout,
-            decode_responses=True
-        )
+        start_time = time.perf_counter()
+        r = get_redis()
 
-        # Test basic operations
-        r.ping()
-        test_key = "__health_check__"
-        r.set(test_key, "ok", ex=10)  # Expire in 10 seconds
-        value = r.get(test_key)
-        r.delete(test_key)
+        if level == "liveness":
+            r.ping()
+        else:
+            # Test basic operations in a single round trip
+            test_key = "__health_check__"
+            pipe = r.pipeline()
+            pipe.ping()
+            pipe.set(test_key, "ok", ex=10)  # Expire in 10 seconds
+            pipe.get(test_key)
+            pipe.delete(test_key)
+            _, _, value, _ = pipe.execute()
 
-        response_time = round((time.time() - start_time) * 1000, 2)
+            if value != "ok":
+                raise Exception("Redis test operation failed")
 
-        if value != "ok":
-            raise Exception("Redis test operation failed")
+        response_time = round((time.perf_counter() - start_time) * 1000, 2)
 
         return {
             "status": "healthy",
+            "level": level,
             "response_time_ms": response_time,
             "host": config.redis_host,
             "port": config.redis_port
@@ -288,6 +1438,7 @@ def check_redis() -> Dict[str, Any]:
         logger.warning(f"Redis connection error: {e}")
         return {
             "status": "unhealthy",
+            "level": level,
             "error": f"Connection failed: {str(e)}",
             "host": config.redis_host,
             "port": config.redis_port
@@ -296,57 +1447,56 @@ def check_redis() -> Dict[str, Any]:
         logger.error(f"Redis health check failed: {e}")
         return {
             "status": "unhealthy",
+            "level": level,
             "error": str(e),
             "host": config.redis_host,
             "port": config.redis_port
         }
 
-def check_postgres() -> Dict[str, Any]:
+def check_postgres(level: str = "readiness") -> Dict[str, Any]:
     """Check PostgreSQL connectivity and basic functionality"""
     try:
-        start_time = time.time()
-        conn_params = {
-            "host": config.pg_host,
-            "port": config.pg_port,
-            "user": config.pg_user,
-            "database": config.pg_db,
-            "connect_timeout": config.connection_timeout
-        }
-
-        if config.pg_password:
-            conn_params["password"] = config.pg_password
+        start_time = time.perf_counter()
 
-        conn = psycopg2.connect(**conn_params)
-        cursor = conn.cursor()
+        with pg_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                if level != "liveness" and "postgres_version" not in _static_info:
+                    cursor.execute("SELECT version();")
+                    _static_info["postgres_version"] = cursor.fetchone()[0].split()[0:2]
 
-        # Test basic query
-        cursor.execute("SELECT version();")
-        version = cursor.fetchone()[0]
+                # Test basic query
+                cursor.execute("SELECT 1 as health_check;")
+                result = cursor.fetchone()[0]
 
-        # Test write capability with a temporary table
-        cursor.execute("SELECT 1 as health_check;")
-        result = cursor.fetchone()[0]
+                if level == "deep":
+                    # Test write capability with a temporary table
+                    conn.autocommit = False
+                    cursor.execute("CREATE TEMP TABLE __health_check (value int) ON COMMIT DROP;")
+                    cursor.execute("INSERT INTO __health_check VALUES (1) RETURNING value;")
+                    result = cursor.fetchone()[0]
+                    conn.rollback()
 
-        cursor.close()
-        conn.close()
-
-        response_time = round((time.time() - start_time) * 1000, 2)
+        response_time = round((time.perf_counter() - start_time) * 1000, 2)
 
         if result != 1:
             raise Exception("PostgreSQL test query failed")
 
-        return {
+        status = {
             "status": "healthy",
+            "level": level,
             "response_time_ms": response_time,
             "host": config.pg_host,
-            "port": config.pg_port,
-            "version": version.split()[0:2]  # Just PostgreSQL version
+            "port": config.pg_port
         }
+        if "postgres_version" in _static_info:
+            status["version"] = _static_info["postgres_version"]  # Just PostgreSQL version
+        return status
 
     except psycopg2.OperationalError as e:
         logger.warning(f"PostgreSQL connection error: {e}")
         return {
             "status": "unhealthy",
+            "level": level,
             "error": f"Connection failed: {str(e)}",
             "host": config.pg_host,
             "port": config.pg_port
@@ -355,51 +1505,69 @@ def check_postgres() -> Dict[str, Any]:
         logger.error(f"PostgreSQL health check failed: {e}")
         return {
             "status": "unhealthy",
+            "level": level,
             "error": str(e),
             "host": config.pg_host,
             "port": config.pg_port
         }
 
-def check_s3() -> Dict[str, Any]:
+def check_s3(level: str = "readiness") -> Dict[str, Any]:
     """Check S3/Garage connectivity and basic functionality"""
     try:
-        start_time = time.time()
+        start_time = time.perf_counter()
 
         # Get S3 client (may return None if credentials not available)
         client = get_s3_client()
         if client is None:
             return {
                 "status": "unhealthy",
-                "error": "S3 credentials not available",
+                "level": level,
+                "error": "S3 circuit open" if not breakers["s3"].available() else "S3 credentials not available",
                 "endpoint": config.s3_endpoint
             }
 
-        # Test bucket access
-        client.head_bucket(Bucket=config.s3_bucket)
+        if level == "liveness":
+            client.head_bucket(Bucket=config.s3_bucket)
+        else:
+            # Bucket existence only needs confirming once
+            if not _static_info.get("s3_bucket_exists"):
+                client.head_bucket(Bucket=config.s3_bucket)
+                _static_info["s3_bucket_exists"] = True
 
-        # Test write operation
-        test_key = f"__health_check_{int(time.time())}.txt"
-        client.put_object(
-            Bucket=config.s3_bucket,
-            Key=test_key,
-            Body=b"health check",
-            ContentType="text/plain"
-        )
+            # Test read access
+            try:
+                client.list_objects_v2(Bucket=config.s3_bucket, MaxKeys=1)
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'NoSuchBucket':
+                    _static_info.pop("s3_bucket_exists", None)
+                raise
 
-        # Test read operation
-        response = client.get_object(Bucket=config.s3_bucket, Key=test_key)
-        content = response['Body'].read()
+        if level == "deep":
+            # Test write operation
+            test_key = f"__health_check_{int(time.time())}.txt"
+            client.put_object(
+                Bucket=config.s3_bucket,
+                Key=test_key,
+                Body=b"health check",
+                ContentType="text/plain"
+            )
 
-        # Cleanup
-        client.delete_object(Bucket=config.s3_bucket, Key=test_key)
+            # Test read operation
+            try:
+                response = client.get_object(Bucket=config.s3_bucket, Key=test_key)
+                content = response['Body'].read()
+            finally:
+                # Cleanup
+                client.delete_object(Bucket=config.s3_bucket, Key=test_key)
 
-        response_time = round((time.time() - start_time) * 1000, 2)
+            if content != b"health check":
+                raise Exception("S3 test operation failed")
 
-        if content != b"health check":
-            raise Exception("S3 test operation failed")
+        response_time = round((time.perf_counter() - start_time) * 1000, 2)
 
         return {
             "status": "healthy",
+            "level": level,
             "response_time_ms": response_time,
             "endpoint": config.s3_endpoint,
             "bucket": config.s3_bucket
@@ -409,6 +1577,7 @@ def check_s3() -> Dict[str, Any]:
         logger.warning(f"S3 client error: {e}")
         return {
             "status": "unhealthy",
+            "level": level,
             "error": f"S3 error: {str(e)}",
             "endpoint": config.s3_endpoint
         }
@@ -416,162 +1585,2867 @@ def check_s3() -> Dict[str, Any]:
         logger.error(f"S3 health check failed: {e}")
         return {
             "status": "unhealthy",
+            "level": level,
             "error": str(e),
             "endpoint": config.s3_endpoint
         }
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    """Handle file upload to S3"""
-    if 'file' not in request.files:
-        return jsonify({"error": "No file provided"}), 400
+HEALTH_CHECKS = {
+    "redis": check_redis,
+    "postgres": check_postgres,
+    "s3": check_s3
+}
 
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({"error": "No file selected"}), 400
+# Bounded pool so a hung backend cannot spawn unbounded probe threads
+health_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.health_max_workers,
+    thread_name_prefix="health-check"
+)
 
-    try:
-        # Get S3 client
-        client = get_s3_client()
-        if client is None:
-            return jsonify({"error": "S3 service not available"}), 503
+# Upper bounds of the probe latency histogram: each bucket is 15% wider than the
+# last, so a percentile read from the buckets is within ~7% of the true value
+HISTORY_LATENCY_BOUNDS = tuple(0.1 * 1.15 ** i for i in range(96))  # 0.1ms .. ~60s
 
-        # Generate unique key for the file
-        filename = secure_filename(file.filename)
-        unique_key = f"{uuid.uuid4()}_{filename}"
+class ProbeRollup:
+    """Ring of fixed-width time buckets aggregating probe samples
 
-        # Upload to S3
-        client.put_object(
-            Bucket=config.s3_bucket,
-            Key=unique_key,
-            Body=file.read(),
-            ContentType=file.content_type or 'application/octet-stream',
-            Metadata={
-                'original-filename': filename,
-                'upload-timestamp': str(int(time.time()))
-            }
-        )
+    Each bucket holds the probe and error counts, the seconds the service
+    was up and down, and a latency histogram of the successful probes, all
+    in flat arrays. A bucket is reset when its slot comes round again.
+    """
 
-        logger.info(f"File uploaded successfully: {unique_key}")
-        return jsonify({
-            "message": "File uploaded successfully",
-            "key": unique_key,
-            "filename": filename
-        })
+    def __init__(self, resolution: int, size: int):
+        self.resolution = resolution
+        self.size = size
+        self.bins = len(HISTORY_LATENCY_BOUNDS) + 1  # the last bin is "slower than every bound"
+        self.epochs = array('q', [-1]) * size
+        self.counts = array('I', [0]) * size
+        self.errors = array('I', [0]) * size
+        self.up = array('d', [0.0]) * size
+        self.down = array('d', [0.0]) * size
+        self.max_ms = array('d', [0.0]) * size
+        self.histogram = array('I', [0]) * (size * self.bins)
 
-    except Exception as e:
-        logger.error(f"File upload failed: {e}")
-        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+    def _slot(self, epoch: int) -> int:
+        slot = epoch % self.size
+        if self.epochs[slot] != epoch:
+            self.epochs[slot] = epoch
+            self.counts[slot] = self.errors[slot] = 0
+            self.up[slot] = self.down[slot] = self.max_ms[slot] = 0.0
+            start = slot * self.bins
+            self.histogram[start:start + self.bins] = array('I', [0]) * self.bins
+        return slot
 
-@app.route('/file/<key>')
-def download_file(key):
-    """Download file from S3"""
+    def add(self, timestamp: float, ok: bool, latency_ms: float, up: float, down: float):
+        slot = self._slot(int(timestamp // self.resolution))
+        self.counts[slot] += 1
+        self.up[slot] += up
+        self.down[slot] += down
+        if not ok:
+            self.errors[slot] += 1
+            return
+        self.histogram[slot * self.bins + bisect.bisect_left(HISTORY_LATENCY_BOUNDS, latency_ms)] += 1
+        self.max_ms[slot] = max(self.max_ms[slot], latency_ms)
+
+    def summary(self, since: float, until: float) -> Dict[str, Any]:
+        """Aggregate the buckets overlapping [since, until], without touching raw samples"""
+        totals = {"samples": 0, "errors": 0, "up": 0.0, "down": 0.0, "max_ms": 0.0}
+        histogram = [0] * self.bins
+        points = []
+        first = int(since // self.resolution)
+        last = int(until // self.resolution)
+        for epoch in range(max(first, last - self.size + 1), last + 1):
+            slot = epoch % self.size
+            if self.epochs[slot] != epoch or not self.counts[slot]:
+                continue
+            start = slot * self.bins
+            bucket = self.histogram[start:start + self.bins]
+            for i, n in enumerate(bucket):
+                histogram[i] += n
+            totals["samples"] += self.counts[slot]
+            totals["errors"] += self.errors[slot]
+            totals["up"] += self.up[slot]
+            totals["down"] += self.down[slot]
+            totals["max_ms"] = max(totals["max_ms"], self.max_ms[slot])
+            points.append({
+                "timestamp": epoch * self.resolution,
+                "samples": self.counts[slot],
+                "error_rate": round(self.errors[slot] / self.counts[slot], 4),
+                "p95_ms": histogram_percentile(bucket, 0.95, self.max_ms[slot])
+            })
+        return dict(totals, histogram=histogram, points=points)
+
+def histogram_percentile(histogram, q: float, max_ms: float) -> Optional[float]:
+    """Percentile of a latency histogram: the geometric middle of the bucket holding it"""
+    count = sum(histogram)
+    if not count:
+        return None
+    rank = max(math.ceil(q * count), 1)
+    seen = 0
+    for i, n in enumerate(histogram):
+        seen += n
+        if seen >= rank:
+            break
+    if i >= len(HISTORY_LATENCY_BOUNDS):
+        return round(max_ms, 2)
+    upper = HISTORY_LATENCY_BOUNDS[i]
+    estimate = math.sqrt(HISTORY_LATENCY_BOUNDS[i - 1] * upper) if i else upper
+    # The slowest probe bounds every percentile, which keeps sparse buckets honest
+    return round(min(estimate, max_ms), 2)
+
+class ProbeHistory:
+    """Latency and availability history of one service at one probe level
+
+    Raw samples go into a fixed-size ring; 1m and 1h rollups are updated as
+    each sample lands, so a query sums at most one bucket per minute or hour
+    of its window however many probes ran.
+    """
+
+    def __init__(self, samples: int, minutes: int, hours: int):
+        self.timestamps = array('d', [0.0]) * samples
+        self.latencies = array('d', [0.0]) * samples
+        self.ok = array('B', [0]) * samples
+        self.position = 0
+        self.filled = 0
+        self.minutes = ProbeRollup(60, minutes)
+        self.hours = ProbeRollup(3600, hours)
+        self.last = None  # (timestamp, ok) of the previous sample
+
+    def add(self, timestamp: float, ok: bool, latency_ms: float, max_gap: float):
+        if len(self.timestamps):
+            self.timestamps[self.position] = timestamp
+            self.latencies[self.position] = latency_ms
+            self.ok[self.position] = ok
+            self.position = (self.position + 1) % len(self.timestamps)
+            self.filled = min(self.filled + 1, len(self.timestamps))
+
+        # The time since the previous probe counts towards that probe's outcome;
+        # a gap longer than max_gap (the worker was idle or stopped) counts for neither
+        up = down = 0.0
+        if self.last is not None:
+            elapsed = timestamp - self.last[0]
+            if 0 < elapsed <= max_gap:
+                if self.last[1]:
+                    up = elapsed
+                else:
+                    down = elapsed
+        if self.last is None or timestamp >= self.last[0]:
+            self.last = (timestamp, ok)
+        for rollup in (self.minutes, self.hours):
+            if rollup.size:
+                rollup.add(timestamp, ok, latency_ms, up, down)
+
+    def recent(self, limit: int) -> List[Dict[str, Any]]:
+        """The newest raw samples, newest first"""
+        size = len(self.timestamps)
+        samples = []
+        for n in range(1, min(limit, self.filled) + 1):
+            i = (self.position - n) % size
+            samples.append({
+                "timestamp": self.timestamps[i],
+                "status": "healthy" if self.ok[i] else "unhealthy",
+                "response_time_ms": round(self.latencies[i], 2)
+            })
+        return samples
+
+    def rollup_for(self, window: float) -> Optional[ProbeRollup]:
+        """The finest rollup that still covers the whole window"""
+        for rollup in (self.minutes, self.hours):
+            if rollup.size and window <= rollup.size * rollup.resolution:
+                return rollup
+        return None
+
+class HealthHistory:
+    """Per-process probe history of every service, fed by the health prober
+
+    Every worker records the probes run anywhere (see HealthProber), so
+    each holds the same history.
+    """
+
+    def __init__(self, samples: int, minutes: int, hours: int):
+        self.samples = samples
+        self.minutes = minutes
+        self.hours = hours
+        self._lock = threading.Lock()
+        self._histories = {}  # (name, level) -> ProbeHistory
+
+    def after_fork(self):
+        """Keep the samples inherited from the parent, but not its lock"""
+        self._lock = threading.Lock()
+
+    @property
+    def max_window(self) -> int:
+        return max(self.minutes * 60, self.hours * 3600)
+
+    def record(self, name: str, level: str, result: Dict[str, Any], duration_ms: float,
+               timestamp: float, max_gap: float):
+        ok = result.get("status") == "healthy"
+        latency_ms = result.get("response_time_ms", duration_ms)
+        with self._lock:
+            history = self._histories.get((name, level))
+            if history is None:
+                history = ProbeHistory(self.samples, self.minutes, self.hours)
+                self._histories[(name, level)] = history
+            history.add(timestamp, ok, latency_ms, max_gap)
+
+    def summary(self, name: str, level: str, window: float, recent: int = 0) -> Dict[str, Any]:
+        """Percentiles, error rate and availability of a service over the last window seconds"""
+        now = time.time()
+        with self._lock:
+            history = self._histories.get((name, level))
+            rollup = history.rollup_for(window) if history else None
+            if rollup is None:
+                totals = {"samples": 0, "errors": 0, "up": 0.0, "down": 0.0, "max_ms": 0.0,
+                          "histogram": [], "points": []}
+            else:
+                totals = rollup.summary(now - window, now)
+            samples = history.recent(recent) if history and recent else []
+
+        count = totals["samples"]
+        covered = totals["up"] + totals["down"]
+        summary = {
+            "resolution_seconds": rollup.resolution if rollup else None,
+            "samples": count,
+            "errors": totals["errors"],
+            "error_rate": round(totals["errors"] / count, 4) if count else None,
+            # Time-weighted: failing services are probed faster, so counting probes would overstate downtime
+            "availability": round(totals["up"] / covered, 5) if covered else None,
+            "p50_ms": histogram_percentile(totals["histogram"], 0.50, totals["max_ms"]),
+            "p95_ms": histogram_percentile(totals["histogram"], 0.95, totals["max_ms"]),
+            "p99_ms": histogram_percentile(totals["histogram"], 0.99, totals["max_ms"]),
+            "max_ms": round(totals["max_ms"], 2) if totals["max_ms"] else None,
+            "points": totals["points"]
+        }
+        if recent:
+            summary["recent"] = samples
+        return summary
+
+health_history = HealthHistory(
+    samples=config.health_history_samples,
+    minutes=config.health_history_minutes,
+    hours=config.health_history_hours
+)
+
+class HealthProber:
+    """Background prober keeping the latest result of every health check in memory
+
+    Only the worker holding the prober leader lock runs the background
+    probes. Every probe, background or on demand, is published to a Redis
+    stream that the other workers read into their own snapshot and history
+    about once a second. While Redis is unreachable every worker probes for
+    itself.
+    """
+
+    SAMPLES_KEY = "health:samples"
+    LEADER_LOCK = "health-prober"
+    LEADER_TTL = 10
+    SYNC_INTERVAL = 1.0
+
+    def __init__(self, checks: Dict[str, Any], intervals: Dict[str, float], max_staleness: float,
+                 background_levels: List[str], deep_interval: float, retry_interval: float,
+                 history: Optional[HealthHistory] = None):
+        self.checks = checks
+        self.history = history
+        self.intervals = intervals
+        self.max_staleness = max_staleness
+        self.background_levels = background_levels
+        self.deep_interval = deep_interval
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._snapshots = {}  # (name, level) -> {"result", "checked_at", "timestamp"}
+        self._inflight = {}  # (name, level) -> Future shared by every concurrent caller
+        self._next_due = {}  # (name, level) -> monotonic time of the next background probe
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._origin = uuid.uuid4().hex  # tells our own published probes apart
+        self._outbox = []  # (name, level, result, duration_ms, timestamp) not yet published
+        self._leader_token = None
+        self._last_sample_id = "0-0"  # first sync replays what the stream still holds
+
+    @property
+    def retention(self) -> float:
+        """Seconds of published probes kept in Redis for workers that start later"""
+        return self.history.minutes * 60 if self.history is not None else self.max_staleness
+
+    def ensure_started(self):
+        """Start the probing thread (again, if we are in a freshly forked worker)"""
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._inflight = {}
+            self._thread = threading.Thread(target=self._run, name="health-prober", daemon=True)
+            self._thread.start()
+
+    def after_fork(self):
+        """Drop the thread and lock state inherited from the parent process"""
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._inflight = {}
+        self._next_due = {}
+        self._thread = None
+        self._pid = None
+        # The inherited snapshot and history match the inherited stream position
+        self._origin = uuid.uuid4().hex
+        self._outbox = []
+        self._leader_token = None
+
+    def interval(self, name: str, level: str) -> float:
+        # Deep probes write to the backends, so they run on their own slow clock
+        return self.deep_interval if level == "deep" else self.intervals[name]
+
+    def _schedule(self, name: str, level: str, result: Dict[str, Any], checked_at: float):
+        """Pick the next background probe time; unhealthy services are retried quickly"""
+        interval = self.interval(name, level)
+        if result.get("status") != "healthy":
+            interval = min(interval, self.retry_interval)
+        # Jitter keeps workers and services from probing in lockstep
+        self._next_due[(name, level)] = checked_at + interval * random.uniform(0.8, 1.2)
+        self._wakeup.set()
+
+    def _lead(self) -> bool:
+        """Whether this process runs the background probes (always, while Redis is unreachable)"""
+        try:
+            if self._leader_token is not None and extend_lock(self.LEADER_LOCK, self._leader_token,
+                                                              self.LEADER_TTL):
+                return True
+            self._leader_token = acquire_lock(self.LEADER_LOCK, ttl=self.LEADER_TTL)
+        except (redis.RedisError, CircuitOpenError):
+            self._leader_token = None
+            return True
+        return self._leader_token is not None
+
+    def _publish(self):
+        """Send the probes this process ran since the last pass to the other workers"""
+        with self._lock:
+            outbox, self._outbox = self._outbox, []
+        if not outbox:
+            return
+        min_id = f"{int((time.time() - self.retention) * 1000)}-0"
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for name, level, result, duration_ms, timestamp in outbox:
+                pipe.xadd(self.SAMPLES_KEY, {
+                    "origin": self._origin,
+                    "name": name,
+                    "level": level,
+                    "result": json.dumps(result, default=str),
+                    "duration_ms": duration_ms,
+                    "timestamp": timestamp
+                }, minid=min_id, approximate=True)
+            pipe.execute()
+        except (redis.RedisError, CircuitOpenError) as e:
+            logger.debug(f"Could not publish {len(outbox)} probes: {e}")
+
+    def _sync(self):
+        """Take in the probes other processes published since the last sync"""
+        try:
+            while True:
+                streams = get_redis().xread({self.SAMPLES_KEY: self._last_sample_id}, count=1000)
+                entries = streams[0][1] if streams else []
+                for entry_id, fields in entries:
+                    self._last_sample_id = entry_id
+                    if fields.get("origin") != self._origin:
+                        self._ingest(fields)
+                if len(entries) < 1000:
+                    return
+        except (redis.RedisError, CircuitOpenError) as e:
+            logger.debug(f"Could not read published probes: {e}")
+
+    def _ingest(self, fields: Dict[str, str]):
+        name, level = fields.get("name"), fields.get("level")
+        if name not in self.checks or level not in PROBE_LEVELS:
+            return
+        result = json.loads(fields["result"])
+        timestamp = float(fields["timestamp"])
+        if self.history is not None:
+            self.history.record(name, level, result, float(fields["duration_ms"]), timestamp,
+                                max_gap=self.interval(name, level) * 2.5)
+        snapshot = {
+            "result": result,
+            "checked_at": time.monotonic() - max(time.time() - timestamp, 0),
+            "timestamp": timestamp
+        }
+        with self._lock:
+            current = self._snapshots.get((name, level))
+            if current is None or current["timestamp"] < timestamp:
+                self._snapshots[(name, level)] = snapshot
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            self._publish()
+            self._sync()
+            now = time.monotonic()
+            next_due = now + self.SYNC_INTERVAL
+            if self._lead():
+                for name in self.checks:
+                    for level in self.background_levels:
+                        with self._lock:
+                            due = self._next_due.get((name, level), now)
+                        if due <= now:
+                            # Placeholder until the probe lands and reschedules itself
+                            due = now + self.interval(name, level)
+                            with self._lock:
+                                self._next_due[(name, level)] = due
+                            self.refresh(name, level)
+                        next_due = min(next_due, due)
+            self._wakeup.wait(max(next_due - time.monotonic(), 0.1))
+
+    def refresh(self, name: str, level: str = "readiness") -> concurrent.futures.Future:
+        """Probe a service, coalescing with any probe already in flight"""
+        with self._lock:
+            future = self._inflight.get((name, level))
+            if future is None:
+                future = health_executor.submit(self._probe, name, level)
+                self._inflight[(name, level)] = future
+        return future
+
+    def _probe(self, name: str, level: str) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            result = self.checks[name](level)
+        except Exception as e:
+            result = {"status": "unhealthy", "level": level, "error": str(e)}
+        duration_ms = (time.perf_counter() - started) * 1000
+        snapshot = {
+            "result": result,
+            "checked_at": time.monotonic(),
+            "timestamp": time.time()
+        }
+        if self.history is not None:
+            # Two missed probes in a row mean nobody was probing, not that the service was down
+            self.history.record(name, level, result, duration_ms,
+                                snapshot["timestamp"], max_gap=self.interval(name, level) * 2.5)
+        with self._lock:
+            # Published by the prober thread, so a slow Redis never holds up a probe
+            self._outbox.append((name, level, result, duration_ms, snapshot["timestamp"]))
+            self._snapshots[(name, level)] = snapshot
+            self._inflight.pop((name, level), None)
+            self._schedule(name, level, result, snapshot["checked_at"])
+        return snapshot
+
+    def results(self, names: Optional[List[str]] = None, level: str = "readiness",
+                fresh: bool = False) -> Dict[str, Dict[str, Any]]:
+        """Serve results from the snapshot, revalidating stale entries in the background"""
+        self.ensure_started()
+        names = names or list(self.checks)
+        started = time.monotonic()
+
+        results = {}
+        waiting = {}
+        for name in names:
+            with self._lock:
+                snapshot = self._snapshots.get((name, level))
+            age = started - snapshot["checked_at"] if snapshot else None
+            interval = self.interval(name, level)
+            if snapshot is None:
+                waiting[name] = self.refresh(name, level)
+                continue
+            if level == "deep":
+                # Rate limited: a forced deep probe never runs more than once per interval
+                if fresh and age > interval:
+                    waiting[name] = self.refresh(name, level)
+                    continue
+            elif fresh or age > self.max_staleness:
+                waiting[name] = self.refresh(name, level)
+                continue
+            if age > interval:
+                # Stale-while-revalidate: answer now, refresh for the next caller
+                self.refresh(name, level)
+            results[name] = self._with_age(snapshot)
+
+        if waiting:
+            with span("health.wait", ",".join(waiting)):
+                collected = collect_health_checks({"started": started, "futures": waiting})
+            for name, outcome in collected.items():
+                # Probes resolve to a snapshot; only timeouts come back as plain results
+                if outcome.get("status") == "timeout":
+                    results[name] = dict(outcome, level=level)
+                else:
+                    results[name] = self._with_age(outcome)
+        return {name: results[name] for name in names}
+
+    @staticmethod
+    def _with_age(snapshot: Dict[str, Any]) -> Dict[str, Any]:
+        result = dict(snapshot["result"])
+        result["age_seconds"] = round(time.monotonic() - snapshot["checked_at"], 3)
+        result["checked_at"] = snapshot["timestamp"]
+        return result
+
+prober = HealthProber(
+    HEALTH_CHECKS,
+    intervals=config.probe_intervals,
+    max_staleness=config.probe_max_staleness,
+    background_levels=config.probe_levels,
+    deep_interval=config.deep_probe_interval,
+    retry_interval=config.probe_retry_interval,
+    history=health_history
+)
+
+def collect_health_checks(pending: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Gather check results, marking any that miss their deadline as timed out"""
+    started = pending["started"]
+    check_deadline = started + config.health_check_timeout
+    request_deadline = started + config.health_deadline
+
+    results = {}
+    for name, future in pending["futures"].items():
+        remaining = min(check_deadline, request_deadline) - time.monotonic()
+        try:
+            results[name] = future.result(timeout=max(remaining, 0))
+        except concurrent.futures.TimeoutError:
+            # The probe keeps running and will refresh the snapshot when it lands
+            logger.warning(f"{name} health check timed out")
+            results[name] = {
+                "status": "timeout",
+                "error": f"Check did not complete within "
+                         f"{min(config.health_check_timeout, config.health_deadline)}s"
+            }
+    return results
+
+def wants_fresh() -> bool:
+    """Whether the caller asked to bypass the health snapshot with ?fresh=1"""
+    return request.args.get('fresh', '').lower() in ('1', 'true', 'yes')
+
+def requested_level(default: str = "readiness") -> str:
+    """Probe level selected with ?level=liveness|readiness|deep"""
+    level = request.args.get('level', default).lower()
+    if level not in PROBE_LEVELS:
+        abort(make_response(jsonify({"error": f"Unknown probe level: {level}",
+                                     "levels": list(PROBE_LEVELS)}), 400))
+    return level
+
+# S3 limits: parts are at least 5 MiB (except the last) and at most 10000 per upload
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PARTS = 10000
+
+# Shared by every upload; each upload is further capped at s3_upload_concurrency parts
+upload_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.s3_upload_max_workers,
+    thread_name_prefix="s3-upload"
+)
+
+def read_chunk(stream, size: int) -> bytes:
+    """Read up to size bytes, looping over short reads from socket-backed streams"""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+def part_size_for(expected_size: Optional[int]) -> int:
+    """Configured part size, grown if needed to stay within the S3 part limit"""
+    part_size = max(config.s3_part_size, S3_MIN_PART_SIZE)
+    if expected_size:
+        part_size = max(part_size, -(-expected_size // S3_MAX_PARTS))
+    return part_size
+
+def _upload_part(client, key: str, upload_id: str, part_number: int, data: bytes) -> Dict[str, Any]:
+    response = client.upload_part(
+        Bucket=config.s3_bucket,
+        Key=key,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=data
+    )
+    return {"PartNumber": part_number, "ETag": response['ETag']}
+
+def upload_stream(client, key: str, stream, content_type: str, metadata: Dict[str, str],
+                  expected_size: Optional[int] = None) -> int:
+    """Upload a file-like object with memory bounded by part size x concurrency
+
+    Objects smaller than one part go up in a single put_object; anything larger
+    becomes a multipart upload whose parts are sent concurrently. A failed
+    multipart upload is aborted so no incomplete parts are left in the bucket.
+    Returns the number of bytes stored.
+    """
+    started = time.perf_counter()
+    part_size = part_size_for(expected_size)
+    chunk = read_chunk(stream, part_size)
+    if len(chunk) < part_size:
+        client.put_object(
+            Bucket=config.s3_bucket,
+            Key=key,
+            Body=chunk,
+            ContentType=content_type,
+            Metadata=metadata
+        )
+        record_transfer("upload", len(chunk), time.perf_counter() - started)
+        return len(chunk)
+
+    upload_id = client.create_multipart_upload(
+        Bucket=config.s3_bucket,
+        Key=key,
+        ContentType=content_type,
+        Metadata=metadata
+    )['UploadId']
+
+    # One slot per part held in memory: the part being read waits for a free slot
+    slots = threading.BoundedSemaphore(config.s3_upload_concurrency)
+    futures = []
+    size = 0
+    try:
+        slots.acquire()
+        while chunk:
+            if len(futures) >= S3_MAX_PARTS:
+                raise ValueError(f"Upload exceeds {S3_MAX_PARTS} parts of {part_size} bytes")
+            # Carry the request's profiling span into the upload thread
+            future = upload_executor.submit(contextvars.copy_context().run, _upload_part,
+                                            client, key, upload_id, len(futures) + 1, chunk)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+            size += len(chunk)
+            chunk = None
+
+            # Stop reading as soon as any part has failed
+            for done in futures:
+                if done.done() and done.exception() is not None:
+                    raise done.exception()
+
+            slots.acquire()
+            chunk = read_chunk(stream, part_size)
+
+        parts = [future.result() for future in futures]
+        client.complete_multipart_upload(
+            Bucket=config.s3_bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts}
+        )
+        record_transfer("upload", size, time.perf_counter() - started)
+        return size
+
+    except Exception:
+        for future in futures:
+            future.cancel()
+        concurrent.futures.wait(futures)
+        try:
+            client.abort_multipart_upload(Bucket=config.s3_bucket, Key=key, UploadId=upload_id)
+        except Exception as e:
+            logger.warning(f"Failed to abort multipart upload {upload_id} for {key}: {e}")
+        raise
+
+def abort_stale_multipart_uploads(max_age: int) -> int:
+    """Abort incomplete multipart uploads older than max_age seconds (e.g. after a crash)"""
+    client = get_s3_client()
+    if client is None:
+        return 0
+
+    aborted = 0
+    cutoff = time.time() - max_age
+    paginator = client.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=config.s3_bucket):
+        for upload in page.get('Uploads', []):
+            if upload['Initiated'].timestamp() < cutoff:
+                client.abort_multipart_upload(
+                    Bucket=config.s3_bucket,
+                    Key=upload['Key'],
+                    UploadId=upload['UploadId']
+                )
+                aborted += 1
+    if aborted:
+        logger.info(f"Aborted {aborted} stale multipart uploads")
+    return aborted
+
+def run_multipart_cleanup() -> Optional[int]:
+    """Abort stale multipart uploads unless another worker is already doing it"""
+    token = acquire_lock("multipart-cleanup", ttl=max(config.s3_stale_upload_cleanup_interval, 300))
+    if token is None:
+        return None
     try:
+        return abort_stale_multipart_uploads(config.s3_stale_upload_age)
+    finally:
+        release_lock("multipart-cleanup", token)
+
+# Runs in the workers shortly after startup instead of holding up the server
+multipart_cleaner = PeriodicTask(
+    "multipart-cleanup",
+    interval=config.s3_stale_upload_cleanup_interval,
+    func=run_multipart_cleanup,
+    initial_delay=60
+)
+
+# Compression - compressible uploads are stored encoded and decoded only for
+# clients that do not accept the stored encoding
+def storage_encoding(content_type: str) -> Optional[str]:
+    """Encoding to store an upload of this type with, or None to store it as it is"""
+    if not config.compression_enabled:
+        return None
+    mimetype = content_type.split(';')[0].strip().lower()
+    if not any(mimetype.startswith(prefix) for prefix in config.compression_types):
+        return None
+    if config.compression_encoding == 'zstd' and zstandard is not None:
+        return 'zstd'
+    return 'gzip'
+
+def compressor(encoding: str):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=config.zstd_level).compressobj()
+    return zlib.compressobj(config.gzip_level, zlib.DEFLATED, 31)
+
+def decompressor(encoding: str):
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError("Object is zstd-encoded but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(31)
+
+def accepts_encoding(encoding: str) -> bool:
+    """Whether the client's Accept-Encoding allows this content coding"""
+    return request.accept_encodings[encoding] > 0
+
+class CompressingReader:
+    """Read-only file-like wrapper compressing a stream as it is read
+
+    At most one read's worth of compressed output is buffered, so memory
+    stays bounded by the caller's read size.
+    """
+
+    def __init__(self, stream, encoding: str):
+        self.stream = stream
+        self.raw_size = 0
+        self._compressor = compressor(encoding)
+        self._buffer = bytearray()
+        self._eof = False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self.stream.read(config.s3_stream_chunk_size)
+            if chunk:
+                self.raw_size += len(chunk)
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._eof = True
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+def iter_decoded(chunks: Iterator[bytes], encoding: str) -> Iterator[bytes]:
+    """Decode a stream of encoded chunks as it is consumed"""
+    decoder = decompressor(encoding)
+    for chunk in chunks:
+        data = decoder.decompress(chunk)
+        if data:
+            yield data
+    tail = decoder.flush()
+    if tail:
+        yield tail
+
+def response_encoding() -> Optional[str]:
+    """Encoding the client prefers for a compressed response, zstd on a tie"""
+    available = [e for e in ('zstd', 'gzip') if e != 'zstd' or zstandard is not None]
+    accepted = [e for e in available if accepts_encoding(e)]
+    return max(accepted, key=lambda e: request.accept_encodings[e], default=None)
+
+@app.after_request
+def compress_json_response(response: Response) -> Response:
+    """Compress JSON API responses above JSON_COMPRESSION_MIN_BYTES"""
+    if (config.json_compression_min_bytes <= 0 or response.direct_passthrough or response.is_streamed
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    body = response.get_data()
+    if len(body) < config.json_compression_min_bytes:
+        return response
+    encoding = response_encoding()
+    if encoding is None:
+        return response
+    encoder = compressor(encoding)
+    response.set_data(encoder.compress(body) + encoder.flush())
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+def store_upload(client, file, expected_size: Optional[int] = None) -> Tuple[Dict[str, Any], int]:
+    """Store one uploaded file in S3 and the metadata index
+
+    Returns the JSON response body and status code for the file.
+    """
+    # Generate unique key for the file
+    filename = secure_filename(file.filename)
+    unique_key = f"{uuid.uuid4()}_{filename}"
+    content_type = file.content_type or 'application/octet-stream'
+    uploaded_at = datetime.now(timezone.utc)
+
+    metadata = {
+        'original-filename': filename,
+        'upload-timestamp': str(int(uploaded_at.timestamp()))
+    }
+    encoding = storage_encoding(content_type)
+    if encoding is not None:
+        metadata['stored-encoding'] = encoding
+
+    sha256 = None
+    deduplicated = False
+    if isinstance(file.stream, HashingFile):
+        # The body was hashed while it was received; identical bytes share one blob
+        sha256 = file.stream.sha256.hexdigest()
+        size = file.stream.size
+        stream = file.stream if encoding is None else CompressingReader(file.stream, encoding)
+        try:
+            with span("upload.dedup", sha256):
+                deduplicated = store_blob(client, sha256, size, stream, content_type, metadata)
+        except (psycopg2.Error, redis.RedisError, TimeoutError) as e:
+            logger.warning(f"Deduplication unavailable, storing {unique_key} on its own: {e}")
+            sha256 = None
+            file.stream.seek(0)
+
+    if sha256 is None:
+        # Upload to S3 straight from the spooled request body
+        stream = file.stream if encoding is None else CompressingReader(file.stream, encoding)
+        with span("upload.stream", unique_key):
+            size = upload_stream(
+                client,
+                unique_key,
+                stream,
+                content_type=content_type,
+                metadata=metadata,
+                expected_size=expected_size
+            )
+        if encoding is not None:
+            logger.info(f"Stored {unique_key} {encoding}-encoded: {stream.raw_size} -> {size} bytes")
+            size = stream.raw_size
+
+    try:
+        index_file(unique_key, filename, size, content_type, uploaded_at, sha256=sha256)
+    except Exception as e:
+        if sha256 is not None:
+            # A deduplicated file exists only in the index, so without it the upload is lost
+            logger.error(f"Failed to index deduplicated upload {unique_key}: {e}")
+            unreference_blob(client, sha256)
+            object_cache.invalidate(unique_key)
+            return {"error": f"Upload failed: {str(e)}"}, 503
+        # The object is stored; the periodic reconcile will index it later
+        logger.warning(f"Failed to index {unique_key}: {e}")
+    enqueue_thumbnails(unique_key, content_type)
+
+    logger.info(f"File uploaded successfully: {unique_key} ({size} bytes"
+                f"{', deduplicated' if deduplicated else ''})")
+    response = {
+        "message": "File uploaded successfully",
+        "key": unique_key,
+        "filename": filename,
+        "size": size
+    }
+    if sha256 is not None:
+        response["sha256"] = sha256
+        response["deduplicated"] = deduplicated
+    return response, 200
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    """Handle file upload to S3"""
+    if 'file' not in request.files:
+        return jsonify({"error": "No file provided"}), 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({"error": "No file selected"}), 400
+
+    try:
+        # Get S3 client
         client = get_s3_client()
         if client is None:
             return jsonify({"error": "S3 service not available"}), 503
 
-        response = client.get_object(Bucket=config.s3_bucket, Key=key)
+        response, status = store_upload(client, file, expected_size=request.content_length)
+        return jsonify(response), status
+
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except Exception as e:
+        logger.error(f"File upload failed: {e}")
+        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+
+# Shared by every batch upload and archive download; each request is further
+# capped at batch_upload_concurrency files in flight
+batch_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.batch_upload_max_workers,
+    thread_name_prefix="batch"
+)
+
+def stream_size(stream) -> int:
+    """Size of a seekable (spooled) upload stream, leaving it rewound"""
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+def _store_batch_file(client, file) -> Tuple[Dict[str, Any], int]:
+    try:
+        return store_upload(client, file, expected_size=stream_size(file.stream))
+    except CircuitOpenError as e:
+        return {"error": str(e), "retry_after": retry_after_seconds(e)}, 503
+    except Exception as e:
+        logger.error(f"Batch upload of {file.filename} failed: {e}")
+        return {"error": f"Upload failed: {str(e)}"}, 500
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Upload several files (repeated 'file' fields) in one request
+
+    Files are stored concurrently and each gets its own result, in the order
+    they were sent. The response is 200 when every file was stored and 207
+    when some failed.
+    """
+    files = [file for file in request.files.getlist('file') if file.filename != '']
+    if not files:
+        return jsonify({"error": "No file provided"}), 400
+    if len(files) > config.batch_upload_max_files:
+        return jsonify({"error": f"At most {config.batch_upload_max_files} files per batch"}), 400
+
+    client = get_s3_client()
+    if client is None:
+        return jsonify({"error": "S3 service not available"}), 503
+
+    # One slot per file being stored: the next file waits for a free slot
+    slots = threading.BoundedSemaphore(config.batch_upload_concurrency)
+    futures = []
+    for file in files:
+        slots.acquire()
+        future = batch_executor.submit(contextvars.copy_context().run, _store_batch_file, client, file)
+        future.add_done_callback(lambda _: slots.release())
+        futures.append(future)
+
+    results = []
+    failed = 0
+    for file, future in zip(files, futures):
+        response, status = future.result()
+        if status != 200:
+            failed += 1
+            response = dict(response, filename=secure_filename(file.filename))
+        results.append(dict(response, status=status))
+
+    return jsonify({
+        "files": results,
+        "uploaded": len(results) - failed,
+        "failed": failed
+    }), 207 if failed else 200
+
+# Hot object cache - small objects kept in Redis so repeat hits skip S3
+_CACHE_PUT = """
+local prev = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0')
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 6))
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+redis.call('ZADD', KEYS[6], tonumber(ARGV[2]) + tonumber(ARGV[4]), ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+local total = redis.call('INCRBY', KEYS[4], tonumber(ARGV[3]) - prev)
+local dropped = {}
+local function drop(victim)
+    redis.call('ZREM', KEYS[2], victim)
+    redis.call('ZREM', KEYS[6], victim)
+    total = redis.call('DECRBY', KEYS[4], tonumber(redis.call('HGET', KEYS[3], victim) or '0'))
+    redis.call('HDEL', KEYS[3], victim)
+    dropped[#dropped + 1] = victim
+end
+-- Expired entries are gone from Redis but still counted: drop them before evicting live ones
+for _, victim in ipairs(redis.call('ZRANGEBYSCORE', KEYS[6], '-inf', ARGV[2])) do
+    drop(victim)
+end
+local expired = #dropped
+while total > tonumber(ARGV[5]) do
+    local oldest = redis.call('ZRANGE', KEYS[2], 0, 0)
+    if #oldest == 0 then break end
+    drop(oldest[1])
+end
+if #dropped > expired then redis.call('HINCRBY', KEYS[5], 'evictions', #dropped - expired) end
+return dropped
+"""
+
+_CACHE_GET = """
+local entry = redis.call('HGETALL', KEYS[1])
+if #entry > 0 and redis.call('HEXISTS', KEYS[3], ARGV[1]) == 0 then
+    -- Evicted by a put that has not deleted the body yet
+    redis.call('DEL', KEYS[1])
+    entry = {}
+end
+if #entry == 0 then
+    redis.call('HINCRBY', KEYS[4], 'misses', 1)
+    redis.call('ZREM', KEYS[6], ARGV[1])
+    if redis.call('ZREM', KEYS[2], ARGV[1]) == 1 then
+        redis.call('DECRBY', KEYS[5], tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0'))
+        redis.call('HDEL', KEYS[3], ARGV[1])
+    end
+    return entry
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+redis.call('HINCRBY', KEYS[4], 'hits', 1)
+return entry
+"""
+
+_CACHE_DELETE = """
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[5], ARGV[1])
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 1 then
+    redis.call('DECRBY', KEYS[4], tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0'))
+    redis.call('HDEL', KEYS[3], ARGV[1])
+end
+return 1
+"""
+
+class ObjectCache:
+    """Read-through Redis cache of small object bodies plus their response headers
+
+    Entries expire after a TTL and the least recently used ones are evicted
+    once the total size passes the memory budget. Every operation is a single
+    Lua script, so the size accounting stays consistent across workers. The
+    scripts only touch keys they are given; a put returns the entries it
+    dropped and their bodies are deleted afterwards, and a read treats a
+    body left over from a dropped entry as a miss.
+    """
+
+    PREFIX = "objcache:"
+
+    def __init__(self, enabled: bool, max_object_bytes: int, budget_bytes: int, ttl: int):
+        self.enabled = enabled
+        self.max_object_bytes = max_object_bytes
+        self.budget_bytes = budget_bytes
+        self.ttl = ttl
+        self.lru_key = f"{self.PREFIX}lru"
+        self.sizes_key = f"{self.PREFIX}sizes"
+        self.total_key = f"{self.PREFIX}bytes"
+        self.stats_key = f"{self.PREFIX}stats"
+        self.expiry_key = f"{self.PREFIX}expiry"
+        self.data_prefix = f"{self.PREFIX}data:"
+
+    def cacheable(self, size: int) -> bool:
+        return self.enabled and size <= self.max_object_bytes
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Cached object in get_object response shape, or None on a miss"""
+        if not self.enabled:
+            return None
+        try:
+            entry = get_redis(binary=True).eval(
+                _CACHE_GET, 6,
+                self.data_prefix + key, self.lru_key, self.sizes_key, self.stats_key, self.total_key,
+                self.expiry_key,
+                key, time.time()
+            )
+        except redis.RedisError as e:
+            logger.warning(f"Object cache read failed for {key}: {e}")
+            return None
+        if not entry:
+            return None
+
+        fields = dict(zip(entry[0::2], entry[1::2]))
+        body = fields.pop(b'body')
+        metadata = {name.decode()[5:]: value.decode() for name, value in fields.items()
+                    if name.startswith(b'meta:')}
+        response = {
+            'Body': body,
+            'ContentLength': len(body),
+            'ContentType': fields[b'content_type'].decode(),
+            'Metadata': metadata
+        }
+        if b'etag' in fields:
+            response['ETag'] = fields[b'etag'].decode()
+        if b'last_modified' in fields:
+            response['LastModified'] = datetime.fromtimestamp(int(fields[b'last_modified']), timezone.utc)
+        return response
+
+    def put(self, key: str, response: Dict[str, Any], body: bytes):
+        """Cache an object read from S3 along with the headers we serve it with"""
+        if not self.cacheable(len(body)):
+            return
+        fields = [b'body', body, b'content_type', response.get('ContentType', 'application/octet-stream')]
+        if response.get('ETag'):
+            fields.extend([b'etag', response['ETag']])
+        if response.get('LastModified'):
+            fields.extend([b'last_modified', int(response['LastModified'].timestamp())])
+        for name, value in response.get('Metadata', {}).items():
+            fields.extend([f"meta:{name}", value])
+        try:
+            r = get_redis(binary=True)
+            dropped = r.eval(
+                _CACHE_PUT, 6,
+                self.data_prefix + key, self.lru_key, self.sizes_key, self.total_key,
+                self.stats_key, self.expiry_key,
+                key, time.time(), len(body), self.ttl, self.budget_bytes, *fields
+            )
+            if dropped:
+                r.delete(*[self.data_prefix.encode() + victim for victim in dropped])
+        except redis.RedisError as e:
+            logger.warning(f"Object cache write failed for {key}: {e}")
+
+    def invalidate(self, key: str):
+        """Drop an object that was overwritten or deleted"""
+        if not self.enabled:
+            return
+        try:
+            get_redis(binary=True).eval(
+                _CACHE_DELETE, 5,
+                self.data_prefix + key, self.lru_key, self.sizes_key, self.total_key,
+                self.expiry_key,
+                key
+            )
+        except redis.RedisError as e:
+            logger.warning(f"Object cache invalidation failed for {key}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        r = get_redis()
+        pipe = r.pipeline(transaction=False)
+        pipe.hgetall(self.stats_key)
+        pipe.get(self.total_key)
+        pipe.zcard(self.lru_key)
+        counters, total, entries = pipe.execute()
+        hits = int(counters.get('hits', 0))
+        misses = int(counters.get('misses', 0))
+        return {
+            "enabled": self.enabled,
+            "hits": hits,
+            "misses": misses,
+            "evictions": int(counters.get('evictions', 0)),
+            "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+            "entries": entries,
+            "bytes": int(total or 0),
+            "budget_bytes": self.budget_bytes,
+            "max_object_bytes": self.max_object_bytes
+        }
+
+object_cache = ObjectCache(
+    enabled=config.object_cache_enabled,
+    max_object_bytes=config.object_cache_max_object_bytes,
+    budget_bytes=config.object_cache_budget_bytes,
+    ttl=config.object_cache_ttl
+)
+
+def fetch_object(client, key: str, head: bool = False) -> Dict[str, Any]:
+    """get_object (or head_object) through the hot object cache (Range requests bypass it)
+
+    Conditional request headers are forwarded to S3, which answers 304
+    without sending the body; that comes back as a response with
+    NotModified set and no Body.
+    """
+    params = get_object_args()
+    if "Range" not in params:
+        cached = object_cache.get(key)
+        if cached is not None:
+            return cached
+
+    try:
+        response = get_file_object(client, key, head=head, **params)
+        if response.get('ContentRange') and needs_decoding(response):
+            # Byte ranges index the stored encoding; a client that can't take it gets the whole file
+            response['Body'].close()
+            del params["Range"]
+            response = get_file_object(client, key, **params)
+    except ClientError as e:
+        if e.response['Error']['Code'] != '304':
+            raise
+        headers = e.response['ResponseMetadata']['HTTPHeaders']
+        response = {'NotModified': True, 'ETag': headers.get('etag')}
+        if headers.get('last-modified'):
+            response['LastModified'] = parse_date(headers['last-modified'])
+        return response
+    if head:
+        return response
+    if "Range" not in params and object_cache.cacheable(response['ContentLength']):
+        body = response['Body'].read()
+        object_cache.put(key, response, body)
+        response['Body'] = body
+    return response
+
+@app.route('/api/cache/stats')
+def cache_stats():
+    """Hit/miss counters and memory use of the hot object cache"""
+    try:
+        return jsonify(object_cache.stats())
+    except redis.RedisError as e:
+        return jsonify({"error": f"Cache stats unavailable: {str(e)}"}), 503
+
+def get_object_args() -> Dict[str, Any]:
+    """get_object parameters forwarded from the request: byte Range and conditional headers"""
+    params = {}
+    range_header = request.headers.get('Range')
+    if range_header and range_header.startswith('bytes='):
+        params["Range"] = range_header
+    if request.if_none_match:
+        # If-None-Match compares weakly, and the tags we hand out for decoded bodies are weak
+        etags = request.if_none_match
+        params["IfNoneMatch"] = "*" if etags.star_tag else ", ".join(
+            quote_etag(tag) for tag in sorted(etags.as_set(include_weak=True)))
+    elif request.if_modified_since is not None:
+        params["IfModifiedSince"] = request.if_modified_since
+    return params
+
+def needs_decoding(response: Dict[str, Any]) -> bool:
+    """Whether an object is stored in an encoding the client does not accept"""
+    encoding = response.get('Metadata', {}).get('stored-encoding')
+    return encoding is not None and not accepts_encoding(encoding)
+
+def cache_control(max_age: int, immutable: bool = False) -> str:
+    """Cache-Control value for a download; 0 makes clients revalidate every time"""
+    if max_age <= 0:
+        return "no-cache"
+    return f"public, max-age={max_age}" + (", immutable" if immutable else "")
+
+def not_modified(response: Dict[str, Any]) -> bool:
+    """Whether the client's copy (If-None-Match / If-Modified-Since) is still current"""
+    if response.get('NotModified'):
+        return True
+    if request.if_none_match:
+        etag = response.get('ETag')
+        return etag is not None and request.if_none_match.contains_weak(unquote_etag(etag)[0])
+    last_modified = response.get('LastModified')
+    if request.if_modified_since is not None and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+def range_not_satisfiable(error: ClientError) -> Tuple[Response, int]:
+    """416 for an InvalidRange error, with the object's size in Content-Range"""
+    response = jsonify({"error": "Requested range not satisfiable"})
+    size = error.response['Error'].get('ActualObjectSize')
+    if size is not None:
+        response.headers['Content-Range'] = f"bytes */{size}"
+    return response, 416
+
+def iter_object_body(body, chunk_size: int) -> Iterator[bytes]:
+    """Yield an S3 body in fixed-size chunks, releasing the connection at the end"""
+    started = time.perf_counter()
+    sent = 0
+    try:
+        for chunk in body.iter_chunks(chunk_size):
+            yield chunk
+            sent += len(chunk)
+    finally:
+        body.close()
+        record_transfer("download", sent, time.perf_counter() - started)
+
+def attachment_disposition(filename: str) -> str:
+    """Content-Disposition value for downloading under the original filename"""
+    try:
+        filename.encode('ascii')
+        return dump_options_header('attachment', {'filename': filename})
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        quoted = quote(filename, safe="!#$&+-.^_`|~")
+        return dump_options_header('attachment', {"filename": simple, "filename*": f"UTF-8''{quoted}"})
+
+def object_response(response: Dict[str, Any], download_name: Optional[str] = None,
+                    cache: str = "no-cache") -> Response:
+    """Stream a get_object response to the client without buffering the object
+
+    Bodies already in memory (from the object cache) are sent as they are,
+    head_object responses (no Body) send headers only, and a client whose
+    copy is current gets a bodyless 304. Objects stored compressed are sent
+    in their stored encoding when the client accepts it, and decoded while
+    streaming otherwise; the decoded representation gets a weak ETag since
+    its bytes differ from the stored ones.
+    """
+    headers = Headers()
+    headers['Cache-Control'] = cache
+    encoding = response.get('Metadata', {}).get('stored-encoding')
+    if encoding is not None:
+        headers['Vary'] = 'Accept-Encoding'
+    decode = needs_decoding(response)
+    if response.get('ETag'):
+        etag = response['ETag']
+        headers['ETag'] = etag if not decode or etag.startswith('W/') else f"W/{etag}"
+    if response.get('LastModified'):
+        headers['Last-Modified'] = http_date(response['LastModified'])
+
+    if not_modified(response):
+        if not isinstance(response.get('Body', b''), bytes):
+            response['Body'].close()
+        return Response(status=304, headers=headers)
+
+    if encoding is not None and not decode:
+        headers['Content-Encoding'] = encoding
+    headers['Accept-Ranges'] = 'none' if decode else 'bytes'
+    if not decode:
+        # Decoded size is only known once the whole body has been read
+        headers['Content-Length'] = str(response['ContentLength'])
+    status = 200
+    if response.get('ContentRange'):
+        headers['Content-Range'] = response['ContentRange']
+        status = 206
+
+    if download_name is not None:
+        headers['Content-Disposition'] = attachment_disposition(download_name)
+
+    body = response.get('Body')
+    if body is None:
+        body = iter(())  # Not a sequence, so werkzeug leaves Content-Length alone
+    elif isinstance(body, bytes):
+        if request.method != 'HEAD':
+            record_transfer("download", len(body), 0)
+        if decode:
+            body = iter_decoded(iter([body]), encoding)
+    else:
+        body = iter_object_body(body, config.s3_stream_chunk_size)
+        if decode:
+            body = iter_decoded(body, encoding)
+
+    return Response(
+        body,
+        status=status,
+        headers=headers,
+        content_type=response.get('ContentType', 'application/octet-stream'),
+        direct_passthrough=True
+    )
+
+@app.route('/file/<key>')
+def download_file(key):
+    """Download file from S3"""
+    try:
+        if config.s3_presigned_mode:
+            response = presigned_redirect(key, as_attachment=True)
+            if response is not None:
+                return response
+
+        client = get_s3_client()
+        if client is None:
+            return jsonify({"error": "S3 service not available"}), 503
+
+        response = fetch_object(client, key, head=request.method == 'HEAD')
 
         # Get original filename from metadata
         metadata = response.get('Metadata', {})
         filename = metadata.get('original-filename', key)
 
-        # Create file-like object
-        file_obj = BytesIO(response['Body'].read())
-
-        return send_file(
-            file_obj,
-            as_attachment=True,
-            download_name=filename,
-            mimetype=response.get('ContentType', 'application/octet-stream')
-        )
+        return object_response(response, download_name=filename,
+                               cache=cache_control(config.file_cache_max_age, immutable=True))
 
     except ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchKey':
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
             return jsonify({"error": "File not found"}), 404
+        if e.response['Error']['Code'] == 'InvalidRange':
+            return range_not_satisfiable(e)
         return jsonify({"error": f"Download failed: {str(e)}"}), 500
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
     except Exception as e:
         logger.error(f"File download failed: {e}")
         return jsonify({"error": f"Download failed: {str(e)}"}), 500
 
+# ZIP archives of several files, streamed while they are read from S3
+class ArchiveSink:
+    """Write-only file zipfile writes into; the generator drains what was written
+
+    It has no tell() or seek(), so zipfile writes each member in one pass
+    with a data descriptor after the data instead of seeking back to patch
+    the local header.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def archive_member_name(filename: str, used: set) -> str:
+    """Unique name within the archive, numbering repeated filenames"""
+    name = filename
+    stem, dot, ext = filename.rpartition('.')
+    if not dot:
+        stem, ext = filename, ''
+    n = 1
+    while name in used:
+        n += 1
+        name = f"{stem} ({n}).{ext}" if dot else f"{stem} ({n})"
+    used.add(name)
+    return name
+
+def iter_archive(client, keys: List[str]) -> Iterator[bytes]:
+    """Yield a ZIP of the given files, holding at most one chunk per file in memory
+
+    Members are stored rather than deflated: uploads are mostly images and
+    other already-compressed files. The next object is requested while the
+    current one streams, so S3 latency is paid once rather than per file.
+    """
+    started = time.perf_counter()
+    sent = 0
+    sink = ArchiveSink()
+    used = set()
+    pending = batch_executor.submit(get_file_object, client, keys[0]) if keys else None
+    try:
+        with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for i, key in enumerate(keys):
+                try:
+                    response = pending.result()
+                except ClientError as e:
+                    # Deleted since the request was checked; leave it out
+                    logger.warning(f"Skipping {key} in archive: {e}")
+                    response = None
+                pending = batch_executor.submit(get_file_object, client, keys[i + 1]) if i + 1 < len(keys) else None
+                if response is None:
+                    continue
+
+                filename = response.get('Metadata', {}).get('original-filename') or filename_from_key(key)
+                modified = response.get('LastModified') or datetime.now(timezone.utc)
+                info = zipfile.ZipInfo(archive_member_name(filename, used),
+                                       date_time=max(modified.timetuple()[:6], (1980, 1, 1, 0, 0, 0)))
+                info.compress_type = zipfile.ZIP_STORED
+                # Lets zipfile pick ZIP64 headers up front for members over 4 GiB
+                info.file_size = response['ContentLength']
+                body = response['Body']
+                chunks = body.iter_chunks(config.s3_stream_chunk_size)
+                encoding = response.get('Metadata', {}).get('stored-encoding')
+                if encoding is not None:
+                    chunks = iter_decoded(chunks, encoding)
+                try:
+                    # The decoded size of a compressed object is unknown, so allow for ZIP64
+                    with archive.open(info, 'w', force_zip64=encoding is not None) as member:
+                        for chunk in chunks:
+                            member.write(chunk)
+                            data = sink.drain()
+                            sent += len(data)
+                            yield data
+                finally:
+                    body.close()
+                data = sink.drain()
+                sent += len(data)
+                yield data
+        data = sink.drain()
+        sent += len(data)
+        yield data
+    finally:
+        if pending is not None:
+            pending.cancel()
+        record_transfer("download", sent, time.perf_counter() - started)
+
+@app.route('/files/archive', methods=['GET', 'POST'])
+def download_archive():
+    """Download several files as one ZIP built on the fly
+
+    Keys come from repeated 'key' query parameters or, for long lists, a
+    JSON body {"keys": [...]}. Every key must exist; missing keys are
+    reported with 404 before anything is streamed.
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        keys = body.get('keys')
+        name = body.get('name')
+        if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+            return jsonify({"error": "Expected a JSON body with a 'keys' list"}), 400
+    else:
+        keys = request.args.getlist('key')
+        name = request.args.get('name')
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return jsonify({"error": "No keys provided"}), 400
+    if len(keys) > config.archive_max_keys:
+        return jsonify({"error": f"At most {config.archive_max_keys} files per archive"}), 400
+
+    client = get_s3_client()
+    if client is None:
+        return jsonify({"error": "S3 service not available"}), 503
+
+    try:
+        # The index knows most keys; anything it is missing is checked in the bucket
+        indexed = lookup_files(keys)
+        missing = []
+        for key in keys:
+            if key in indexed:
+                continue
+            if is_internal_key(key):
+                missing.append(key)
+                continue
+            try:
+                client.head_object(Bucket=config.s3_bucket, Key=key)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                    raise
+                missing.append(key)
+    except ClientError as e:
+        return jsonify({"error": f"Archive failed: {str(e)}"}), 500
+    if missing:
+        return jsonify({"error": "File not found", "missing": missing}), 404
+
+    name = secure_filename(name or '') or 'files.zip'
+    if not name.lower().endswith('.zip'):
+        name += '.zip'
+    return Response(
+        iter_archive(client, keys),
+        headers={'Content-Disposition': attachment_disposition(name)},
+        content_type='application/zip',
+        direct_passthrough=True
+    )
+
+# Preview derivatives - downscaled copies of images stored next to the original
+THUMBNAIL_QUEUE = "thumbnail:jobs"
+# Kept alive while rendering, so it only limits how long a crashed renderer blocks others
+THUMBNAIL_LOCK_TTL = 30
+
+# Image types Pillow cannot rasterize; they are always previewed as the original
+NON_RASTER_IMAGE_TYPES = {'image/svg+xml'}
+
+class PreviewUnavailable(ValueError):
+    """An image has no preview derivatives; the original is served instead"""
+
+def has_previews(content_type: str) -> bool:
+    """Whether preview derivatives can be generated for a content type"""
+    return content_type.startswith('image/') and content_type not in NON_RASTER_IMAGE_TYPES
+
+def preview_failed(key: str) -> bool:
+    """Whether an earlier attempt found the image undecodable"""
+    try:
+        return bool(get_redis().exists(f"thumbnail:failed:{key}"))
+    except redis.RedisError:
+        return False
+
+def mark_preview_failed(key: str):
+    """Remember an undecodable image so it is not downloaded and decoded again"""
+    try:
+        get_redis().set(f"thumbnail:failed:{key}", 1, ex=config.preview_cache_max_age)
+    except redis.RedisError as e:
+        logger.warning(f"Failed to record preview failure for {key}: {e}")
+
+def thumbnail_format() -> Tuple[str, str, str]:
+    """(Pillow format, content type, extension) for derivatives, JPEG if WebP is unsupported"""
+    if config.thumbnail_format == 'webp' and PIL_features.check('webp'):
+        return 'WEBP', 'image/webp', 'webp'
+    return 'JPEG', 'image/jpeg', 'jpg'
+
+def derived_key(key: str, size: str) -> str:
+    """Bucket key of a preview derivative (internal, so listings skip it)"""
+    return f"__derived/{size}/{key}.{thumbnail_format()[2]}"
+
+def generate_thumbnails(client, key: str):
+    """Decode an image once and store every configured preview size"""
+    response = get_file_object(client, key)
+    try:
+        content_type = response.get('ContentType', '')
+        if not content_type.startswith('image/'):
+            raise ValueError("File is not an image")
+        if not has_previews(content_type):
+            mark_preview_failed(key)
+            raise PreviewUnavailable(f"No previews for {content_type}")
+        if response['ContentLength'] > config.thumbnail_max_source_bytes:
+            mark_preview_failed(key)
+            raise PreviewUnavailable("Image too large to generate previews")
+        data = response['Body'].read()
+    finally:
+        response['Body'].close()
+
+    pil_format, content_type, _ = thumbnail_format()
+    try:
+        source = Image.open(BytesIO(data))
+        # JPEG can decode straight at a reduced scale, which is much cheaper
+        largest = max(config.thumbnail_sizes.values())
+        source.draft('RGB', (largest, largest))
+        source.load()
+        source = ImageOps.exif_transpose(source)
+        if pil_format == 'JPEG' or source.mode not in ('RGB', 'RGBA'):
+            source = source.convert('RGB' if pil_format == 'JPEG' else 'RGBA')
+    except (OSError, Image.DecompressionBombError) as e:  # UnidentifiedImageError is an OSError
+        mark_preview_failed(key)
+        raise PreviewUnavailable(f"Cannot decode image {key}: {e}") from e
+
+    for size, pixels in sorted(config.thumbnail_sizes.items(), key=lambda item: -item[1]):
+        image = source.copy()
+        image.thumbnail((pixels, pixels), Image.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, format=pil_format, quality=config.thumbnail_quality)
+        target = derived_key(key, size)
+        client.put_object(
+            Bucket=config.s3_bucket,
+            Key=target,
+            Body=buffer.getvalue(),
+            ContentType=content_type,
+            Metadata={'source-key': key}
+        )
+        object_cache.invalidate(target)
+    logger.info(f"Generated previews for {key}")
+
+def ensure_thumbnail(client, key: str, size: str) -> str:
+    """Key of a preview derivative, generating it on demand if it is missing
+
+    Generation is single-flight: one worker (in any process) holds a Redis
+    lock and renders, everyone else waits for the derivative to appear.
+    """
+    target = derived_key(key, size)
+    try:
+        client.head_object(Bucket=config.s3_bucket, Key=target)
+        return target
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+    if preview_failed(key):
+        raise PreviewUnavailable(f"No previews for {key}")
+
+    deadline = time.monotonic() + config.thumbnail_wait
+    while time.monotonic() < deadline:
+        try:
+            token = acquire_lock(f"thumbnail:{key}", ttl=THUMBNAIL_LOCK_TTL)
+        except redis.RedisError as e:
+            # No single-flight without Redis, but the preview can still be rendered
+            logger.warning(f"Rendering previews of {key} without a lock: {e}")
+            generate_thumbnails(client, key)
+            return target
+        if token is not None:
+            with lock_held(f"thumbnail:{key}", token, THUMBNAIL_LOCK_TTL):
+                try:
+                    client.head_object(Bucket=config.s3_bucket, Key=target)
+                except ClientError as e:
+                    if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                        raise
+                    generate_thumbnails(client, key)
+            return target
+        time.sleep(0.1)
+        try:
+            client.head_object(Bucket=config.s3_bucket, Key=target)
+            return target
+        except ClientError:
+            if preview_failed(key):
+                raise PreviewUnavailable(f"No previews for {key}")
+    raise TimeoutError(f"Timed out waiting for preview of {key}")
+
+def enqueue_thumbnails(key: str, content_type: str):
+    """Queue background preview generation for a freshly uploaded image"""
+    if Image is None or not has_previews(content_type):
+        return
+    try:
+        get_redis().lpush(THUMBNAIL_QUEUE, key)
+    except redis.RedisError as e:
+        # /preview will generate it on demand instead
+        logger.warning(f"Failed to queue previews for {key}: {e}")
+
+def process_thumbnail_job():
+    """Wait for one preview job and render it
+
+    The wait is a blocking read on its own connection, outside the Redis
+    circuit breaker: an idle queue is not a Redis failure. Redis being
+    unreachable is raised so the worker backs off.
+    """
+    client = get_s3_client()
+    if client is None or not breakers["redis"].available():
+        time.sleep(config.connection_timeout)
+        return
+    job = redis.Redis(connection_pool=redis_blocking_pool).brpop(THUMBNAIL_QUEUE, timeout=QUEUE_POLL_TIMEOUT)
+    if job is None:
+        return
+    key = job[1]
+    try:
+        token = acquire_lock(f"thumbnail:{key}", ttl=THUMBNAIL_LOCK_TTL)
+        if token is None:
+            return  # Already being generated on demand
+        with lock_held(f"thumbnail:{key}", token, THUMBNAIL_LOCK_TTL):
+            generate_thumbnails(client, key)
+    except (ClientError, ValueError) as e:
+        logger.warning(f"Preview generation for {key} failed: {e}")
+
+thumbnail_workers = [
+    QueueWorker(f"thumbnail-worker-{n}", interval=config.connection_timeout, func=process_thumbnail_job)
+    for n in range(config.thumbnail_workers if Image is not None else 0)
+]
+
 @app.route('/preview/<key>')
 def preview_file(key):
-    """Preview file (for images) from S3"""
+    """Preview file (for images) from S3, optionally as a downscaled ?size= derivative"""
+    size = request.args.get('size')
+    if size is not None and size not in config.thumbnail_sizes:
+        return jsonify({"error": f"Unknown preview size: {size}",
+                        "sizes": list(config.thumbnail_sizes)}), 400
+    if Image is None:
+        size = None  # Pillow unavailable: fall back to the original
+
     try:
         client = get_s3_client()
         if client is None:
             return jsonify({"error": "S3 service not available"}), 503
 
-        response = client.get_object(Bucket=config.s3_bucket, Key=key)
+        if size is not None:
+            try:
+                target = ensure_thumbnail(client, key, size)
+            except PreviewUnavailable as e:
+                logger.info(f"Serving the original for {key}: {e}")
+                size = None
+        if size is not None:
+            if config.s3_presigned_mode:
+                return presigned_redirect(target, as_attachment=False, content_type=thumbnail_format()[1])
+            return object_response(fetch_object(client, target, head=request.method == 'HEAD'),
+                                   cache=cache_control(config.preview_cache_max_age))
+
+        if config.s3_presigned_mode:
+            response = presigned_redirect(key, as_attachment=False)
+            if response is not None:
+                return response
+
+        response = fetch_object(client, key, head=request.method == 'HEAD')
         content_type = response.get('ContentType', 'application/octet-stream')
 
-        # Only preview images
-        if not content_type.startswith('image/'):
+        # Only preview images (a 304 means the client already has the image)
+        if not response.get('NotModified') and not content_type.startswith('image/'):
+            if not isinstance(response.get('Body', b''), bytes):
+                response['Body'].close()
             return jsonify({"error": "File is not an image"}), 400
 
-        file_obj = BytesIO(response['Body'].read())
-
-        return send_file(
-            file_obj,
-            mimetype=content_type
-        )
+        return object_response(response, cache=cache_control(config.file_cache_max_age, immutable=True))
 
     except ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchKey':
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
             return jsonify({"error": "File not found"}), 404
+        if e.response['Error']['Code'] == 'InvalidRange':
+            return range_not_satisfiable(e)
         return jsonify({"error": f"Preview failed: {str(e)}"}), 500
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except TimeoutError as e:
+        return jsonify({"error": str(e)}), 503
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
     except Exception as e:
         logger.error(f"File preview failed: {e}")
         return jsonify({"error": f"Preview failed: {str(e)}"}), 500
 
-def list_uploaded_files():
-    """List all uploaded files from S3"""
+# File metadata index - lets listings skip a head_object per key
+METADATA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_metadata (
+    key TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    size BIGINT NOT NULL,
+    content_type TEXT NOT NULL,
+    uploaded_at TIMESTAMPTZ NOT NULL
+);
+CREATE INDEX IF NOT EXISTS file_metadata_uploaded_at_idx
+    ON file_metadata (uploaded_at DESC, key DESC);
+CREATE INDEX IF NOT EXISTS file_metadata_content_type_idx
+    ON file_metadata (content_type, uploaded_at DESC, key DESC);
+CREATE INDEX IF NOT EXISTS file_metadata_key_prefix_idx
+    ON file_metadata (key text_pattern_ops);
+-- Set for deduplicated files, whose bytes live in a shared blob
+ALTER TABLE file_metadata ADD COLUMN IF NOT EXISTS sha256 TEXT;
+CREATE TABLE IF NOT EXISTS file_blobs (
+    sha256 TEXT PRIMARY KEY,
+    size BIGINT NOT NULL,
+    refcount INTEGER NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def ensure_metadata_schema():
+    """Create the metadata index tables once per process"""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        with pg_pool.connection() as conn:
+            conn.autocommit = False
+            with conn.cursor() as cursor:
+                # Serialize concurrent CREATE ... IF NOT EXISTS from several workers
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext('file_metadata_schema'));")
+                cursor.execute(METADATA_SCHEMA)
+            conn.commit()
+        _schema_ready = True
+
+def is_internal_key(key: str) -> bool:
+    """Keys the app writes for itself (health checks etc.) rather than user uploads"""
+    return key.startswith('__')
+
+def filename_from_key(key: str) -> str:
+    """Original filename encoded in a '<uuid>_<filename>' key"""
+    return key.split('_', 1)[1] if '_' in key else key
+
+def index_file(key: str, filename: str, size: int, content_type: str, uploaded_at: datetime,
+               sha256: Optional[str] = None):
+    """Record (or refresh) an object in the metadata index"""
+    ensure_metadata_schema()
+    with pg_pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO file_metadata (key, filename, size, content_type, uploaded_at, sha256)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (key) DO UPDATE SET
+                    filename = EXCLUDED.filename,
+                    size = EXCLUDED.size,
+                    content_type = EXCLUDED.content_type,
+                    uploaded_at = EXCLUDED.uploaded_at,
+                    sha256 = EXCLUDED.sha256;
+                """,
+                (key, filename, size, content_type, uploaded_at, sha256)
+            )
+
+def file_entry(key: str, filename: str, size: int, content_type: str,
+               uploaded_at: datetime) -> Dict[str, Any]:
+    """Shape of a file as rendered by the listing"""
+    return {
+        'key': key,
+        'filename': filename,
+        'size': size,
+        'content_type': content_type,
+        'uploaded_at': uploaded_at.isoformat(),
+        'upload_date': uploaded_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'is_image': content_type.startswith('image/'),
+        'has_previews': has_previews(content_type)
+    }
+
+def encode_cursor(uploaded_at: datetime, key: str) -> str:
+    """Opaque continuation token for the position after (uploaded_at, key)"""
+    raw = json.dumps([uploaded_at.isoformat(), key]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Inverse of encode_cursor; raises ValueError for a malformed token"""
     try:
-        client = get_s3_client()
-        if client is None:
-            return []
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        uploaded_at, key = json.loads(raw)
+        return datetime.fromisoformat(uploaded_at), key
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def content_type_matches(content_type: str, wanted: Optional[str]) -> bool:
+    """Exact match, or a whole major type when the filter ends in '/' (e.g. 'image/')"""
+    if not wanted:
+        return True
+    return content_type.startswith(wanted) if wanted.endswith('/') else content_type == wanted
 
-        response = client.list_objects_v2(Bucket=config.s3_bucket)
-        files = []
+def list_files_from_s3(limit: int, prefix: Optional[str] = None,
+                       content_type: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Fallback listing straight from the bucket, without per-object metadata calls
 
-        for obj in response.get('Contents', []):
-            # Skip health check files
-            if obj['Key'].startswith('__health_check'):
+    Ordering newest-first needs the whole listing, so this only serves a
+    single page and is meant for when the metadata index is unavailable.
+    """
+    client = get_s3_client()
+    if client is None:
+        return []
+
+    files = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=config.s3_bucket, Prefix=prefix or ''):
+        for obj in page.get('Contents', []):
+            if is_internal_key(obj['Key']):
                 continue
+            filename = filename_from_key(obj['Key'])
+            guessed_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            if not content_type_matches(guessed_type, content_type):
+                continue
+            files.append(file_entry(obj['Key'], filename, obj['Size'], guessed_type, obj['LastModified']))
 
-            # Get object metadata
-            try:
-                head_response = client.head_object(Bucket=config.s3_bucket, Key=obj['Key'])
-                metadata = head_response.get('Metadata', {})
-                content_type = head_response.get('ContentType', 'application/octet-stream')
-
-                files.append({
-                    'key': obj['Key'],
-                    'filename': metadata.get('original-filename', obj['Key']),
-                    'size': obj['Size'],
-                    'upload_date': obj['LastModified'].strftime('%Y-%m-%d %H:%M:%S'),
-                    'is_image': content_type.startswith('image/')
-                })
-            except Exception as e:
-                logger.warning(f"Failed to get metadata for {obj['Key']}: {e}")
-                files.append({
-                    'key': obj['Key'],
-                    'filename': obj['Key'],
-                    'size': obj['Size'],
-                    'upload_date': obj['LastModified'].strftime('%Y-%m-%d %H:%M:%S'),
-                    'is_image': False
-                })
+    return sorted(files, key=lambda x: x['uploaded_at'], reverse=True)[:limit]
+
+def like_prefix(value: str) -> str:
+    """LIKE pattern matching strings that start with value, wildcards escaped"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def list_uploaded_files(limit: Optional[int] = None, cursor: Optional[str] = None,
+                        prefix: Optional[str] = None,
+                        content_type: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page of uploaded files, newest first, plus the cursor for the next page
+
+    Pages are read from the metadata index with keyset pagination on
+    (uploaded_at, key), so every page costs one indexed query no matter how
+    deep into the listing it is.
+    """
+    limit = min(limit or config.file_list_limit, config.file_list_max_limit)
+    position = decode_cursor(cursor) if cursor else None
+
+    conditions = []
+    params = []
+    if position is not None:
+        conditions.append("(uploaded_at, key) < (%s, %s)")
+        params.extend(position)
+    if prefix:
+        conditions.append("key LIKE %s")
+        params.append(like_prefix(prefix))
+    if content_type and content_type.endswith('/'):
+        conditions.append("content_type LIKE %s")
+        params.append(like_prefix(content_type))
+    elif content_type:
+        conditions.append("content_type = %s")
+        params.append(content_type)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    try:
+        ensure_metadata_schema()
+        with pg_pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    SELECT key, filename, size, content_type, uploaded_at
+                    FROM file_metadata
+                    {where}
+                    ORDER BY uploaded_at DESC, key DESC
+                    LIMIT %s;
+                    """,
+                    params + [limit + 1]
+                )
+                rows = cur.fetchall()
 
-        return sorted(files, key=lambda x: x['upload_date'], reverse=True)
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][4], rows[-1][0])
+        return [file_entry(*row) for row in rows], next_cursor
 
+    except psycopg2.Error as e:
+        logger.warning(f"Metadata index unavailable, listing from S3: {e}")
+
+    if position is not None:
+        return [], None
+    try:
+        return list_files_from_s3(limit, prefix, content_type), None
     except Exception as e:
         logger.error(f"Failed to list files: {e}")
-        return []
+        return [], None
+
+@app.route('/api/files')
+def api_files():
+    """Cursor-paginated file listing, newest first"""
+    try:
+        limit = int(request.args.get('limit', config.file_list_limit))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+
+    try:
+        files, next_cursor = list_uploaded_files(
+            limit=limit,
+            cursor=request.args.get('cursor'),
+            prefix=request.args.get('prefix'),
+            content_type=request.args.get('content_type')
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({
+        "files": files,
+        "next_cursor": next_cursor,
+        "limit": min(limit, config.file_list_max_limit)
+    })
+
+def reconcile_metadata_index() -> Dict[str, int]:
+    """Backfill the index from the bucket and drop entries whose object is gone"""
+    client = get_s3_client()
+    if client is None:
+        raise RuntimeError("S3 service not available")
+    ensure_metadata_schema()
+
+    started = datetime.now(timezone.utc)
+    seen = []
+    added = 0
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=config.s3_bucket):
+        objects = [obj for obj in page.get('Contents', []) if not is_internal_key(obj['Key'])]
+        if not objects:
+            continue
+        keys = [obj['Key'] for obj in objects]
+        seen.extend(keys)
+
+        with pg_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT key FROM file_metadata WHERE key = ANY(%s);", (keys,))
+                known = {row[0] for row in cursor.fetchall()}
+
+        # Only objects missing from the index need their metadata fetched
+        for obj in objects:
+            if obj['Key'] in known:
+                continue
+            head = client.head_object(Bucket=config.s3_bucket, Key=obj['Key'])
+            metadata = head.get('Metadata', {})
+            uploaded_at = obj['LastModified']
+            if metadata.get('upload-timestamp', '').isdigit():
+                uploaded_at = datetime.fromtimestamp(int(metadata['upload-timestamp']), timezone.utc)
+            index_file(
+                obj['Key'],
+                metadata.get('original-filename', filename_from_key(obj['Key'])),
+                obj['Size'],
+                head.get('ContentType', 'application/octet-stream'),
+                uploaded_at
+            )
+            added += 1
+
+    with pg_pool.connection() as conn:
+        with conn.cursor() as cursor:
+            # Rows created after the listing started may not have been listed yet
+            # Deduplicated files have no object of their own; their blobs are refcounted
+            cursor.execute(
+                "DELETE FROM file_metadata WHERE uploaded_at < %s AND sha256 IS NULL "
+                "AND NOT (key = ANY(%s));",
+                (started, seen)
+            )
+            removed = cursor.rowcount
+
+    logger.info(f"Metadata index reconciled: {len(seen)} objects, {added} added, {removed} removed")
+    return {"objects": len(seen), "added": added, "removed": removed}
+
+def run_metadata_reconcile() -> Optional[Dict[str, int]]:
+    """Reconcile unless another worker is already doing it"""
+    token = acquire_lock("metadata-reconcile", ttl=max(config.metadata_reconcile_interval, 300))
+    if token is None:
+        return None
+    try:
+        return reconcile_metadata_index()
+    finally:
+        release_lock("metadata-reconcile", token)
+
+metadata_reconciler = PeriodicTask(
+    "metadata-reconcile",
+    interval=config.metadata_reconcile_interval,
+    func=run_metadata_reconcile,
+    initial_delay=30
+)
+
+# Content-addressed deduplication: identical uploads share one refcounted blob
+class HashingFile:
+    """Upload spool file that hashes everything the form parser writes to it"""
+
+    def __init__(self, file):
+        self._file = file
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class HashingRequest(Request):
+    """Request whose uploaded files are hashed while they are received"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return HashingFile(stream) if config.dedup_enabled else stream
+
+app.request_class = HashingRequest
+
+def blob_key(sha256: str) -> str:
+    """Object key of the shared blob holding content with this hash"""
+    return f"__blobs/{sha256}"
+
+@contextmanager
+def blob_lock(sha256: str) -> Iterator[None]:
+    """Serialize storing and releasing one blob across every worker
+
+    The lock is kept alive while held, so uploading a multi-GB blob cannot
+    outlast it.
+    """
+    deadline = time.monotonic() + config.dedup_lock_wait
+    while True:
+        token = acquire_lock(f"blob:{sha256}", ttl=config.dedup_lock_ttl)
+        if token is not None:
+            break
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Timed out waiting for blob {sha256}")
+        time.sleep(0.1)
+    with lock_held(f"blob:{sha256}", token, config.dedup_lock_ttl):
+        yield
+
+def reference_blob(sha256: str, size: int) -> bool:
+    """Take a reference on a stored blob, or return False if there is none"""
+    with pg_pool.connection() as conn:
+        with conn.cursor() as cursor:
+            # A blob whose last reference is being released counts as gone
+            cursor.execute(
+                "UPDATE file_blobs SET refcount = refcount + 1 "
+                "WHERE sha256 = %s AND size = %s AND refcount > 0;",
+                (sha256, size)
+            )
+            return cursor.rowcount == 1
+
+def store_blob(client, sha256: str, size: int, stream, content_type: str,
+               metadata: Dict[str, str]) -> bool:
+    """Reference the blob for this content, uploading it only if it is new
+
+    Returns True when an existing blob was reused.
+    """
+    ensure_metadata_schema()
+    if reference_blob(sha256, size):
+        return True
+    with blob_lock(sha256):
+        # Another upload of the same bytes may have stored it while we waited
+        if reference_blob(sha256, size):
+            return True
+        upload_stream(client, blob_key(sha256), stream, content_type, metadata, expected_size=size)
+        with pg_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO file_blobs (sha256, size, refcount) VALUES (%s, %s, 1)
+                    ON CONFLICT (sha256) DO UPDATE SET refcount = file_blobs.refcount + 1;
+                    """,
+                    (sha256, size)
+                )
+    return False
+
+def unreference_blob(client, sha256: str):
+    """Drop one reference to a blob, deleting the blob with its last reference"""
+    with blob_lock(sha256):
+        with pg_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE file_blobs SET refcount = refcount - 1 WHERE sha256 = %s RETURNING refcount;",
+                    (sha256,)
+                )
+                row = cursor.fetchone()
+        if row is None or row[0] > 0:
+            return
+        client.delete_object(Bucket=config.s3_bucket, Key=blob_key(sha256))
+        object_cache.invalidate(blob_key(sha256))
+        with pg_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM file_blobs WHERE sha256 = %s AND refcount <= 0;", (sha256,))
+    logger.info(f"Deleted blob {sha256} with its last reference")
+
+def get_file_object(client, key: str, head: bool = False, **params) -> Dict[str, Any]:
+    """get_object (or head_object) for a file, following deduplicated files to their blob
+
+    Extra keyword arguments (Range, IfNoneMatch, ...) are passed on to S3.
+    """
+    operation = client.head_object if head else client.get_object
+    params["Bucket"] = config.s3_bucket
+
+    entry = None
+    if config.dedup_enabled and not is_internal_key(key):
+        entry = lookup_file(key)
+    if entry is None or "sha256" not in entry:
+        try:
+            return operation(Key=key, **params)
+        except ClientError as e:
+            # Files deduplicated before dedup was switched off only exist as blobs
+            if config.dedup_enabled or e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            entry = lookup_file(key)
+            if entry is None or "sha256" not in entry:
+                raise
+
+    response = operation(Key=blob_key(entry["sha256"]), **params)
+    # The blob carries the first uploader's name and type; this file has its own
+    response['ContentType'] = entry['content_type']
+    response['Metadata'] = dict(response.get('Metadata', {}), **{'original-filename': entry['filename']})
+    return response
+
+def lookup_file(key: str) -> Optional[Dict[str, Any]]:
+    """Metadata index entry for a key, or None if it is not indexed"""
+    try:
+        ensure_metadata_schema()
+        with pg_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT key, filename, size, content_type, uploaded_at, sha256
+                    FROM file_metadata
+                    WHERE key = %s;
+                    """,
+                    (key,)
+                )
+                row = cursor.fetchone()
+    except psycopg2.Error as e:
+        logger.warning(f"Metadata lookup failed for {key}: {e}")
+        return None
+    if row is None:
+        return None
+    entry = file_entry(*row[:5])
+    if row[5] is not None:
+        entry["sha256"] = row[5]
+    return entry
+
+def lookup_files(keys: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Metadata index entries for several keys in one query; unindexed keys are left out"""
+    try:
+        ensure_metadata_schema()
+        with pg_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT key, filename, size, content_type, uploaded_at
+                    FROM file_metadata
+                    WHERE key = ANY(%s);
+                    """,
+                    (keys,)
+                )
+                rows = cursor.fetchall()
+    except psycopg2.Error as e:
+        logger.warning(f"Metadata lookup failed: {e}")
+        return {}
+    return {row[0]: file_entry(*row) for row in rows}
+
+def presigned_redirect(key: str, as_attachment: bool, content_type: Optional[str] = None):
+    """Redirect the client to a short-lived presigned GET URL for the object
+
+    Returns None when the object is stored compressed in an encoding the
+    client does not accept, so the caller serves it (decoded) itself. Keys
+    missing from the metadata index are looked up in the bucket first, so a
+    missing file raises the 404 ClientError instead of redirecting to one.
+    """
+    client = get_presign_client()
+    if client is None:
+        return jsonify({"error": "S3 service not available"}), 503
+
+    encoding = None
+    entry = lookup_file(key) if content_type is None else None
+    if content_type is None and (entry is None or config.compression_enabled):
+        s3 = get_s3_client()
+        if s3 is None:
+            return jsonify({"error": "S3 service not available"}), 503
+        encoding = get_file_object(s3, key, head=True).get('Metadata', {}).get('stored-encoding')
+        if encoding is not None and not accepts_encoding(encoding):
+            return None
+
+    filename = entry['filename'] if entry else filename_from_key(key)
+    if content_type is None:
+        content_type = entry['content_type'] if entry else (
+            mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+
+    object_key = blob_key(entry["sha256"]) if entry and entry.get("sha256") else key
+    params = {"Bucket": config.s3_bucket, "Key": object_key, "ResponseContentType": content_type}
+    if encoding is not None:
+        params["ResponseContentEncoding"] = encoding
+    if as_attachment:
+        params["ResponseContentDisposition"] = attachment_disposition(filename)
+    elif not content_type.startswith('image/'):
+        return jsonify({"error": "File is not an image"}), 400
+
+    url = client.generate_presigned_url('get_object', Params=params, ExpiresIn=config.s3_presign_expiry)
+    return redirect(url, code=302)
+
+def presigned_uploads_disabled():
+    return jsonify({"error": "Presigned uploads are disabled"}), 404
+
+def record_issued_upload(key: str, upload_id: str = ""):
+    """Remember a key handed out by /api/uploads until its URLs can no longer be used
+
+    The record outlives the URLs by another expiry, since a PUT started
+    just before its URL expired still has to finish before completing.
+    """
+    get_redis().set(f"upload:issued:{key}", upload_id, ex=config.s3_presign_expiry * 2)
+
+@app.route('/api/uploads', methods=['POST'])
+def create_presigned_upload():
+    """Issue presigned URLs so the client uploads straight to S3
+
+    Expects JSON with filename, content_type and (for large files) size.
+    Files up to one part get a single PUT URL; larger ones get a multipart
+    upload with one URL per part. Either way the client finishes by calling
+    /api/uploads/<key>/complete.
+    """
+    if not config.s3_presigned_mode:
+        return presigned_uploads_disabled()
+
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename') or '')
+    if not filename:
+        return jsonify({"error": "No filename provided"}), 400
+    content_type = data.get('content_type') or 'application/octet-stream'
+    size = data.get('size')
+    if size is not None and (not isinstance(size, int) or size < 0):
+        return jsonify({"error": "size must be a non-negative integer"}), 400
+
+    try:
+        client = get_s3_client()
+        signer = get_presign_client()
+        if client is None or signer is None:
+            return jsonify({"error": "S3 service not available"}), 503
+
+        unique_key = f"{uuid.uuid4()}_{filename}"
+        metadata = {
+            'original-filename': filename,
+            'upload-timestamp': str(int(time.time()))
+        }
+        part_size = part_size_for(size)
+
+        if size is None or size <= part_size:
+            url = signer.generate_presigned_url(
+                'put_object',
+                Params={
+                    "Bucket": config.s3_bucket,
+                    "Key": unique_key,
+                    "ContentType": content_type,
+                    "Metadata": metadata
+                },
+                ExpiresIn=config.s3_presign_expiry
+            )
+            record_issued_upload(unique_key)
+            headers = {"Content-Type": content_type}
+            headers.update({f"x-amz-meta-{name}": value for name, value in metadata.items()})
+            return jsonify({
+                "key": unique_key,
+                "method": "PUT",
+                "url": url,
+                "headers": headers,
+                "expires_in": config.s3_presign_expiry
+            })
+
+        upload_id = client.create_multipart_upload(
+            Bucket=config.s3_bucket,
+            Key=unique_key,
+            ContentType=content_type,
+            Metadata=metadata
+        )['UploadId']
+        record_issued_upload(unique_key, upload_id)
+        part_count = -(-size // part_size)
+        parts = [
+            {
+                "part_number": part_number,
+                "url": signer.generate_presigned_url(
+                    'upload_part',
+                    Params={
+                        "Bucket": config.s3_bucket,
+                        "Key": unique_key,
+                        "UploadId": upload_id,
+                        "PartNumber": part_number
+                    },
+                    ExpiresIn=config.s3_presign_expiry
+                )
+            }
+            for part_number in range(1, part_count + 1)
+        ]
+        return jsonify({
+            "key": unique_key,
+            "method": "PUT",
+            "upload_id": upload_id,
+            "part_size": part_size,
+            "parts": parts,
+            "expires_in": config.s3_presign_expiry
+        })
+
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except Exception as e:
+        logger.error(f"Presigned upload failed: {e}")
+        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+
+@app.route('/api/uploads/<key>/complete', methods=['POST'])
+def complete_presigned_upload(key):
+    """Finish a direct upload and record it in the metadata index
+
+    For multipart uploads the JSON body carries upload_id and the parts as
+    [{"part_number": n, "etag": "..."}] in the order they were uploaded.
+    Only keys (and upload ids) issued by /api/uploads, and not yet
+    completed, can be completed.
+    """
+    if not config.s3_presigned_mode:
+        return presigned_uploads_disabled()
+    if is_internal_key(key):
+        return jsonify({"error": "Invalid key"}), 400
+
+    data = request.get_json(silent=True) or {}
+    try:
+        issued = get_redis().get(f"upload:issued:{key}")
+        if issued is None or issued != (data.get('upload_id') or ''):
+            return jsonify({"error": "Upload not found"}), 404
+
+        client = get_s3_client()
+        if client is None:
+            return jsonify({"error": "S3 service not available"}), 503
+
+        if data.get('upload_id'):
+            parts = [{"PartNumber": int(part['part_number']), "ETag": part['etag']}
+                     for part in data.get('parts', [])]
+            client.complete_multipart_upload(
+                Bucket=config.s3_bucket,
+                Key=key,
+                UploadId=data['upload_id'],
+                MultipartUpload={"Parts": sorted(parts, key=lambda part: part["PartNumber"])}
+            )
+
+        # Trust what actually landed in the bucket, not what the client claims
+        head = client.head_object(Bucket=config.s3_bucket, Key=key)
+        metadata = head.get('Metadata', {})
+        filename = metadata.get('original-filename', filename_from_key(key))
+        uploaded_at = head['LastModified']
+        if metadata.get('upload-timestamp', '').isdigit():
+            uploaded_at = datetime.fromtimestamp(int(metadata['upload-timestamp']), timezone.utc)
+        index_file(key, filename, head['ContentLength'],
+                   head.get('ContentType', 'application/octet-stream'), uploaded_at)
+        enqueue_thumbnails(key, head.get('ContentType', 'application/octet-stream'))
+        get_redis().delete(f"upload:issued:{key}")
+
+        logger.info(f"Direct upload completed: {key}")
+        return jsonify({
+            "message": "File uploaded successfully",
+            "key": key,
+            "filename": filename,
+            "size": head['ContentLength']
+        })
+
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Invalid parts list"}), 400
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404', 'NoSuchUpload'):
+            return jsonify({"error": "Upload not found"}), 404
+        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except Exception as e:
+        logger.error(f"Completing direct upload failed: {e}")
+        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+
+@app.route('/api/uploads/<key>', methods=['DELETE'])
+def abort_presigned_upload(key):
+    """Abandon a direct multipart upload (?upload_id=...)"""
+    if not config.s3_presigned_mode:
+        return presigned_uploads_disabled()
+
+    upload_id = request.args.get('upload_id')
+    if not upload_id:
+        return jsonify({"error": "No upload_id provided"}), 400
+    try:
+        client = get_s3_client()
+        if client is None:
+            return jsonify({"error": "S3 service not available"}), 503
+        client.abort_multipart_upload(Bucket=config.s3_bucket, Key=key, UploadId=upload_id)
+        get_redis().delete(f"upload:issued:{key}")
+        return jsonify({"message": "Upload aborted", "key": key})
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchUpload':
+            return jsonify({"error": "Upload not found"}), 404
+        return jsonify({"error": f"Abort failed: {str(e)}"}), 500
+
+@app.route('/api/files/reconcile', methods=['POST'])
+def reconcile_files():
+    """Backfill the metadata index from the bucket on demand"""
+    try:
+        result = run_metadata_reconcile()
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except Exception as e:
+        logger.error(f"Metadata reconcile failed: {e}")
+        return jsonify({"error": f"Reconcile failed: {str(e)}"}), 500
+    if result is None:
+        return jsonify({"error": "Reconcile already in progress"}), 409
+    return jsonify(result)
+
+def sample_pool_metrics():
+    """Record how many pooled connections this process has in use"""
+    for name, pool in (("redis", redis_pool), ("redis_binary", redis_binary_pool)):
+        in_use, idle = pool.usage()
+        POOL_CONNECTIONS.labels(name, "in_use").set(in_use)
+        POOL_CONNECTIONS.labels(name, "idle").set(idle)
+        POOL_CONNECTIONS.labels(name, "max").set(pool.max_connections)
+    stats = pg_pool.stats()
+    POOL_CONNECTIONS.labels("postgres", "in_use").set(stats["open"] - stats["idle"])
+    POOL_CONNECTIONS.labels("postgres", "idle").set(stats["idle"])
+    POOL_CONNECTIONS.labels("postgres", "max").set(stats["max"])
+
+pool_metrics_sampler = PeriodicTask(
+    "pool-metrics",
+    interval=config.metrics_sample_interval if metrics_enabled else 0,
+    func=sample_pool_metrics
+)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics, aggregated across every worker process"""
+    if not metrics_enabled:
+        return jsonify({"error": "Metrics are disabled or prometheus_client is not installed"}), 501
+
+    sample_pool_metrics()
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry),
+                    content_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+@app.before_request
+def start_request_metrics():
+    """Count the request as in flight and start its clock"""
+    if metrics_enabled:
+        g.metrics_started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+
+@app.after_request
+def observe_request(response):
+    """Record time to response headers; streamed bodies are counted as transfers"""
+    started = g.get('metrics_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        REQUEST_SECONDS.labels(request.method, route, str(response.status_code)).observe(
+            time.perf_counter() - started)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    """Runs even when a request fails, so the in-flight gauge never leaks"""
+    if g.pop('metrics_started', None) is not None:
+        REQUESTS_IN_FLIGHT.dec()
+
+class StackSampler:
+    """Sample one thread's Python stack on a timer, counting collapsed stacks
+
+    Samples are taken on wall-clock time, so stacks blocked on I/O are
+    counted too. The output is in the collapsed format flame graph tools read.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> "StackSampler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> Dict[str, Any]:
+        self._stop.set()
+        self._thread.join()
+        return {
+            "interval_ms": self.interval * 1000,
+            "samples": sum(self.stacks.values()),
+            "stacks": dict(sorted(self.stacks.items(), key=lambda item: item[1], reverse=True))
+        }
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if frames:
+                stack = ";".join(reversed(frames))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+PROFILE_BACKENDS = ("redis", "postgres", "s3")
+
+def server_timing(root: Span) -> str:
+    """Server-Timing header: top-level steps, time summed per backend, and the total"""
+    steps = {}
+    for child in root.children:
+        if child.name.split(' ', 1)[0] not in PROFILE_BACKENDS:
+            steps[child.name] = steps.get(child.name, 0) + (child.duration or 0)
+
+    backends = {}
+    pending = list(root.children)
+    while pending:
+        node = pending.pop()
+        backend = node.name.split(' ', 1)[0]
+        if backend in PROFILE_BACKENDS:
+            backends[backend] = backends.get(backend, 0) + (node.duration or 0)
+        pending.extend(node.children)
+
+    entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in {**steps, **backends}.items()]
+    entries.append(f"total;dur={root.duration * 1000:.2f}")
+    return ", ".join(entries)
+
+profile_log = logging.getLogger(f"{__name__}.profile")
+profile_log.propagate = False
+_profile_log_lock = threading.Lock()
+_profile_log_pid = None
+
+def write_profile_log(trace: Dict[str, Any]):
+    """Append a profile as one JSON line to this process's rotating log file"""
+    global _profile_log_pid
+    if not config.profiling_log_file:
+        return
+    with _profile_log_lock:
+        if _profile_log_pid != os.getpid():
+            # Workers cannot safely rotate a shared file, so {pid} in the path gives each its own
+            for handler in list(profile_log.handlers):
+                profile_log.removeHandler(handler)
+            profile_log.addHandler(logging.handlers.RotatingFileHandler(
+                config.profiling_log_file.format(pid=os.getpid()),
+                maxBytes=config.profiling_log_max_bytes,
+                backupCount=config.profiling_log_backups
+            ))
+            profile_log.setLevel(logging.INFO)
+            _profile_log_pid = os.getpid()
+    profile_log.info(json.dumps(trace))
+
+def save_profile(trace: Dict[str, Any]):
+    """Keep a profile in Redis for /debug/profiles and in the log file if configured"""
+    summary = {key: trace[key] for key in ("id", "method", "path", "status", "duration_ms", "timestamp")}
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.set(f"profile:{trace['id']}", json.dumps(trace), ex=config.profiling_ttl)
+        pipe.lpush("profile:recent", json.dumps(summary))
+        pipe.ltrim("profile:recent", 0, config.profiling_keep - 1)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Failed to store profile {trace['id']}: {e}")
+    try:
+        write_profile_log(trace)
+    except OSError as e:
+        logger.warning(f"Failed to write profile {trace['id']}: {e}")
+
+@app.before_request
+def start_profile():
+    """Profile this request when profiling is enabled and the header asks for it"""
+    if not config.profiling_enabled:
+        return
+    mode = request.headers.get(config.profiling_header, '').lower()
+    if mode not in ('1', 'true', 'yes', 'cpu'):
+        return
+    root = Span("request", f"{request.method} {request.path}")
+    sampler = None
+    if mode == 'cpu':
+        sampler = StackSampler(threading.get_ident(), config.profiling_sample_interval).start()
+    g.profile = {"root": root, "token": current_span.set(root), "sampler": sampler}
+
+@app.after_request
+def finish_profile(response):
+    """Attach the finished span tree to the response and store it"""
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+
+    root = profile["root"]
+    root.finish()
+    current_span.reset(profile["token"])
+    trace = {
+        "id": uuid.uuid4().hex,
+        "method": request.method,
+        "path": request.full_path.rstrip('?'),
+        "status": response.status_code,
+        "duration_ms": round(root.duration * 1000, 3),
+        "timestamp": time.time(),
+        "pid": os.getpid(),
+        "spans": root.to_dict(root.started)
+    }
+    if profile["sampler"] is not None:
+        trace["cpu_profile"] = profile["sampler"].stop()
+
+    response.headers['Server-Timing'] = server_timing(root)
+    response.headers['X-Profile-Id'] = trace["id"]
+    save_profile(trace)
+    return response
+
+@app.teardown_request
+def abandon_profile(exc):
+    """Never let a profile outlive its request on this thread"""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        current_span.reset(profile["token"])
+        if profile["sampler"] is not None:
+            profile["sampler"].stop()
+
+@app.route('/debug/profiles')
+def list_profiles():
+    """Most recent request profiles, newest first"""
+    if not config.profiling_enabled:
+        abort(404)
+    entries = get_redis().lrange("profile:recent", 0, config.profiling_keep - 1)
+    return jsonify({"profiles": [json.loads(entry) for entry in entries]})
+
+@app.route('/debug/profiles/<profile_id>')
+def get_profile(profile_id):
+    """Span tree (and CPU samples, if taken) of one profiled request"""
+    if not config.profiling_enabled:
+        abort(404)
+    trace = get_redis().get(f"profile:{profile_id}")
+    if trace is None:
+        return jsonify({"error": "Profile not found or expired"}), 404
+    return Response(trace, content_type='application/json')
+
+# Admission control - bound concurrent transfers so bursts queue briefly or are
+# turned away instead of exhausting worker threads and starving /health
+class AdmissionController:
+    """Per-process concurrency and in-flight bytes limits for transfer route classes
+
+    Requests over a class limit wait (at most queue_depth of them, for at
+    most queue_timeout) and are then refused with 429. Waiting requests hold
+    a thread too, so active plus waiting transfers never exceed lane
+    threads; past that they are refused with 503 at once. Routes outside
+    the transfer classes (health checks above all) are never held up.
+    """
+
+    def __init__(self, lane: int, limits: Dict[str, Tuple[int, int]], queue_depth: int,
+                 queue_timeout: float):
+        self.lane = lane
+        self.limits = limits  # class -> (max concurrent, max in-flight bytes; 0 is unlimited)
+        self.queue_depth = queue_depth
+        self.queue_timeout = queue_timeout
+        self.after_fork()
+
+    def _fits(self, route_class: str, size: int) -> bool:
+        max_concurrent, max_bytes = self.limits[route_class]
+        if self.in_flight[route_class] >= max_concurrent:
+            return False
+        # A request larger than the whole budget still runs, just on its own
+        held = self.in_flight_bytes[route_class]
+        return max_bytes <= 0 or held == 0 or held + size <= max_bytes
+
+    def admit(self, route_class: str, size: int) -> Optional[Tuple[int, str]]:
+        """Take a slot, waiting briefly if needed; returns (status, reason) when refused"""
+        deadline = time.monotonic() + self.queue_timeout
+        with self._cond:
+            if self.active + self.waiting >= self.lane:
+                return 503, "Server busy with transfers"
+            queued = False
+            try:
+                while not self._fits(route_class, size):
+                    if not queued:
+                        if self.queued[route_class] >= self.queue_depth:
+                            return 429, f"Too many concurrent {route_class}s"
+                        self.queued[route_class] += 1
+                        self.waiting += 1
+                        queued = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return 429, f"Too many concurrent {route_class}s"
+                    self._cond.wait(remaining)
+            finally:
+                if queued:
+                    self.queued[route_class] -= 1
+                    self.waiting -= 1
+            self.in_flight[route_class] += 1
+            self.in_flight_bytes[route_class] += size
+            self.active += 1
+        if metrics_enabled:
+            ADMISSION_IN_FLIGHT.labels(route_class).inc()
+        return None
+
+    def release(self, route_class: str, size: int):
+        with self._cond:
+            self.in_flight[route_class] -= 1
+            self.in_flight_bytes[route_class] -= size
+            self.active -= 1
+            self._cond.notify_all()
+        if metrics_enabled:
+            ADMISSION_IN_FLIGHT.labels(route_class).dec()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                route_class: {
+                    "in_flight": self.in_flight[route_class],
+                    "in_flight_bytes": self.in_flight_bytes[route_class],
+                    "queued": self.queued[route_class]
+                }
+                for route_class in self.limits
+            }
+
+    def after_fork(self):
+        """Fresh condition and counters (also the initial state)"""
+        self._cond = threading.Condition()
+        self.in_flight = {route_class: 0 for route_class in self.limits}
+        self.in_flight_bytes = {route_class: 0 for route_class in self.limits}
+        self.queued = {route_class: 0 for route_class in self.limits}
+        self.active = 0
+        self.waiting = 0
+
+admission = AdmissionController(
+    lane=max(config.web_threads - config.health_reserved_threads, 1),
+    limits={
+        "upload": (config.upload_max_concurrent, config.upload_max_inflight_bytes),
+        "download": (config.download_max_concurrent, 0)
+    },
+    queue_depth=config.admission_queue_depth,
+    queue_timeout=config.admission_queue_timeout
+)
+
+# Endpoint -> admission class; anything not listed is not limited
+ROUTE_CLASSES = {
+    'upload_file': 'upload',
+    'upload_batch': 'upload',
+    'download_file': 'download',
+    'preview_file': 'download',
+    'download_archive': 'download'
+}
+
+@app.before_request
+def admit_request():
+    """Enforce body size limits, then admit a transfer or turn it away before its body is read"""
+    route_class = ROUTE_CLASSES.get(request.endpoint)
+    limit = config.max_upload_bytes if route_class == 'upload' else config.max_request_bytes
+    request.max_content_length = limit if limit > 0 else None
+    if request.max_content_length is not None and (request.content_length or 0) > request.max_content_length:
+        return jsonify({"error": f"Request body larger than {request.max_content_length} bytes"}), 413
+    if route_class is None:
+        return None
+
+    size = request.content_length or 0
+    if route_class == 'upload' and request.content_length is None:
+        # A chunked body's size is unknown until it is read: charge the most it may be,
+        # or the whole budget when uploads are unlimited, so it runs on its own
+        size = request.max_content_length or config.upload_max_inflight_bytes
+    refused = admission.admit(route_class, size)
+    if refused is not None:
+        status, message = refused
+        if metrics_enabled:
+            ADMISSION_REJECTED.labels(route_class, str(status)).inc()
+        response = jsonify({"error": message})
+        response.headers['Retry-After'] = str(config.admission_retry_after)
+        return response, status
+    g.admission = (route_class, size)
+    return None
+
+@app.after_request
+def hold_admission(response):
+    """Keep the transfer's slot until its (possibly streamed) body has been sent"""
+    admitted = g.pop('admission', None)
+    if admitted is None:
+        return response
+    released = []
+
+    def release():
+        if not released:
+            released.append(True)
+            admission.release(*admitted)
+
+    response.call_on_close(release)
+    if response.direct_passthrough:
+        # Passthrough bodies go straight to the server, which never calls Response.close()
+        response.response = ClosingIterator(response.response, release)
+    return response
+
+@app.teardown_request
+def release_admission(exc):
+    """Release the slot of a request that never produced a response"""
+    admitted = g.pop('admission', None)
+    if admitted is not None:
+        admission.release(*admitted)
+
+@app.before_request
+def start_background_tasks():
+    """Make sure this process runs its background threads"""
+    prober.ensure_started()
+    metadata_reconciler.ensure_started()
+    multipart_cleaner.ensure_started()
+    pool_metrics_sampler.ensure_started()
+    for worker in thumbnail_workers:
+        worker.ensure_started()
+
+def start_worker():
+    """Warm the PostgreSQL pool in the background and start this process's threads"""
+    threading.Thread(target=pg_pool.prewarm, name="pg-prewarm", daemon=True).start()
+    start_background_tasks()
+
+def circuit_open_response(e: CircuitOpenError):
+    """503 telling the client when the backend's circuit lets a trial through"""
+    response = jsonify({"status": "error", "message": str(e), "timestamp": time.time()})
+    response.headers['Retry-After'] = str(retry_after_seconds(e))
+    return response, 503
+
+def retry_after_seconds(e: CircuitOpenError) -> int:
+    return max(math.ceil(e.retry_after), 1)
 
 @app.errorhandler(Exception)
 def handle_exception(e):
     """Global exception handler"""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, CircuitOpenError):
+        return circuit_open_response(e)
     logger.error(f"Unhandled exception: {e}")
     return jsonify({
         "status": "error",
@@ -579,31 +4453,156 @@ def handle_exception(e):
         "timestamp": time.time()
     }), 500
 
+def reinit_after_fork():
+    """Rebuild per-process state in a freshly forked worker
+
+    Sockets, threads and locks do not survive fork() in a usable state, so
+    every client, pool, executor and background thread inherited from the
+    preloading master is replaced. Imported modules stay shared
+    copy-on-write; boto3 is only imported by whichever process first
+    talks to S3.
+    """
+    global s3_client, presign_client, _s3_client_lock, health_executor, upload_executor, batch_executor
+
+    s3_client = None
+    presign_client = None
+    _s3_client_lock = threading.Lock()
+    redis_pool.reset()
+    redis_binary_pool.reset()
+    redis_blocking_pool.reset()
+    pg_pool.reset()
+    health_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=config.health_max_workers,
+        thread_name_prefix="health-check"
+    )
+    upload_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=config.s3_upload_max_workers,
+        thread_name_prefix="s3-upload"
+    )
+    batch_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=config.batch_upload_max_workers,
+        thread_name_prefix="batch"
+    )
+    for breaker in breakers.values():
+        breaker.after_fork()
+    admission.after_fork()
+    health_history.after_fork()
+    prober.after_fork()
+    metadata_reconciler.after_fork()
+    multipart_cleaner.after_fork()
+    pool_metrics_sampler.after_fork()
+    for worker in thumbnail_workers:
+        worker.after_fork()
+
+def clear_metrics_dir():
+    """Remove the multi-process metric files left by earlier runs"""
+    if not metrics_enabled or 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return
+    for entry in os.scandir(os.environ['PROMETHEUS_MULTIPROC_DIR']):
+        if entry.name.endswith('.db'):
+            os.remove(entry.path)
+
+def mark_worker_dead(pid: int):
+    """Drop a dead worker's live gauges (in-flight requests, pool connections)"""
+    if metrics_enabled and 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
+
+def serve_production():
+    """Serve with a pre-forking gunicorn master and threaded workers"""
+    from gunicorn.app.base import BaseApplication
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            settings = {
+                "bind": f"0.0.0.0:{config.app_port}",
+                "workers": config.web_workers,
+                "threads": config.web_threads,
+                "worker_class": "gthread",
+                "timeout": config.web_timeout,
+                "graceful_timeout": config.web_graceful_timeout,
+                "keepalive": config.web_keepalive,
+                "max_requests": config.web_max_requests,
+                "max_requests_jitter": config.web_max_requests_jitter,
+                "preload_app": True,
+                "post_fork": lambda server, worker: reinit_after_fork(),
+                "post_worker_init": lambda worker: start_worker(),
+                "child_exit": lambda server, worker: mark_worker_dead(worker.pid),
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    # Metric files of a previous run would be summed into this one
+    clear_metrics_dir()
+
+    # Nothing opened in the master may leak into the workers
+    pg_pool.closeall()
+    redis_pool.disconnect()
+    redis_binary_pool.disconnect()
+    redis_blocking_pool.disconnect()
+
+    logger.info(f"Starting gunicorn with {config.web_workers} workers x "
+                f"{config.web_threads} threads on port {config.app_port}")
+    ProductionServer().run()
+
+def wait_for_services(timeout: float) -> Dict[str, bool]:
+    """Poll every backend concurrently until it is ready or the timeout expires"""
+    deadline = time.monotonic() + timeout
+
+    def poll(name: str, check) -> bool:
+        while True:
+            try:
+                if check("readiness").get("status") == "healthy":
+                    logger.info(f"{name} is ready")
+                    return True
+            except Exception as e:
+                logger.debug(f"{name} readiness check failed: {e}")
+            # Short jittered polls so one slow backend never delays the others
+            delay = min(config.probe_retry_interval * random.uniform(0.5, 1.5),
+                        deadline - time.monotonic())
+            if delay <= 0:
+                return False
+            time.sleep(delay)
+
+    # A private executor, shut down before any fork, keeps the master thread-free
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(HEALTH_CHECKS)) as executor:
+        futures = {name: executor.submit(poll, name, check) for name, check in HEALTH_CHECKS.items()}
+        ready = {name: future.result() for name, future in futures.items()}
+
+    if all(ready.values()):
+        logger.info("All services are healthy")
+    else:
+        waiting = ", ".join(name for name, ok in ready.items() if not ok)
+        logger.warning(f"Services not ready after {timeout}s ({waiting}), starting app anyway")
+    return ready
+
+# Everything above runs on every cold start, including each reloaded worker
+import_time_ms = (time.perf_counter() - _import_started) * 1000
+if import_time_ms > config.import_time_budget_ms:
+    logger.warning(f"Import took {import_time_ms:.0f} ms, over the "
+                   f"{config.import_time_budget_ms:.0f} ms budget")
+else:
+    logger.info(f"Import took {import_time_ms:.0f} ms")
+
 if __name__ == '__main__':
     logger.info("Starting Nixify Health Check App...")
 
-    # Wait for services with exponential backoff
-    max_retries = 10
-    for attempt in range(max_retries):
-        redis_ok = check_redis().get("status") == "healthy"
-        postgres_ok = check_postgres().get("status") == "healthy"
-        s3_ok = check_s3().get("status") == "healthy"
+    # Serving starts right away; the prober reports per-service readiness meanwhile
+    if config.startup_readiness_timeout > 0:
+        wait_for_services(config.startup_readiness_timeout)
 
-        if redis_ok and postgres_ok and s3_ok:
-            logger.info("All services are healthy, starting Flask app")
-            break
+    if config.server_mode == 'gunicorn' and importlib.util.find_spec('gunicorn') is None:
+        logger.warning("gunicorn is not installed, falling back to the development server")
+        config.server_mode = 'development'
 
-        wait_time = min(2 ** attempt, 30)  # Cap at 30 seconds
-        logger.info(f"Waiting for services... (attempt {attempt + 1}/{max_retries}, "
-                   f"redis: {'ok' if redis_ok else 'not ready'}, "
-                   f"postgres: {'ok' if postgres_ok else 'not ready'}, "
-                   f"s3: {'ok' if s3_ok else 'not ready'})")
-        time.sleep(wait_time)
+    if config.server_mode == 'gunicorn':
+        serve_production()
     else:
-        logger.warning("Services may not be fully ready, but starting app anyway")
-
-    app.run(
-        host='0.0.0.0',
-        port=config.app_port,
-        debug=False
-    )
+        start_worker()
+        app.run(
+            host='0.0.0.0',
+            port=config.app_port,
+            debug=False
+        )
@@ -0,0 +1,620 @@
+"""Benchmark harness for the Nixify Health Check app
+
+Starts the app (gunicorn, as in production) against local stand-ins for its
+backends, drives it over HTTP at configurable concurrency and records
+p50/p95/p99 latency, requests per second, throughput and the peak RSS of the
+app's process tree. Results are written as JSON so runs can be compared:
+
+    python benchmark.py run --output after.json
+    python benchmark.py compare before.json after.json
+"""
+import argparse
+import concurrent.futures
+import http.client
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("benchmark")
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+BENCH_BUCKET = "bench-bucket"
+SEED_CONCURRENCY = 32
+BLOCK = os.urandom(1024 * 1024)  # Incompressible filler for request bodies
+SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+COUNT_UNITS = {"": 1, "K": 1000, "M": 1000 ** 2}
+
+# Same defaults as the app, for --external-backends
+EXTERNAL_DEFAULTS = {
+    "REDIS_HOST": "127.0.0.1",
+    "REDIS_PORT": "6379",
+    "PG_HOST": "127.0.0.1",
+    "PG_PORT": "5432",
+    "POSTGRES_USER": "postgres",
+    "POSTGRES_DB": "postgres",
+    "POSTGRES_PASSWORD": "",
+    "GARAGE_S3_ENDPOINT": "http://127.0.0.1:3900",
+    "GARAGE_S3_REGION": "garage",
+    "AWS_ACCESS_KEY_ID": "",
+    "AWS_SECRET_ACCESS_KEY": "",
+    "S3_BUCKET": BENCH_BUCKET,
+}
+
+def parse_size(value: str) -> int:
+    """'1KB', '16MB', '1GB' -> bytes (binary units)"""
+    value = value.strip().upper()
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True):
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * SIZE_UNITS[unit])
+    return int(value)
+
+def parse_count(value: str) -> int:
+    """'10', '1k', '100k' -> object count"""
+    value = value.strip().upper()
+    if value and value[-1] in COUNT_UNITS:
+        return int(float(value[:-1]) * COUNT_UNITS[value[-1]])
+    return int(value)
+
+def format_size(size: int) -> str:
+    for unit in ("GB", "MB", "KB"):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit}"
+    return f"{size}B"
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_until(predicate: Callable[[], bool], timeout: float, what: str):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if predicate():
+                return
+        except Exception:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Timed out waiting for {what}")
+
+def port_open(port: int) -> bool:
+    with socket.socket() as sock:
+        sock.settimeout(0.5)
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+class Backends:
+    """Local redis-server, PostgreSQL and moto S3 server in a scratch directory"""
+
+    def __init__(self, workdir: str):
+        self.workdir = workdir
+        self.processes = []
+        self.pg_data = os.path.join(workdir, "postgres")
+        self.env = {}
+
+    def start(self) -> Dict[str, str]:
+        redis_port, pg_port, s3_port = free_port(), free_port(), free_port()
+
+        self._spawn("redis", ["redis-server", "--port", str(redis_port), "--bind", "127.0.0.1",
+                              "--save", "", "--appendonly", "no"])
+
+        subprocess.run(["initdb", "-D", self.pg_data, "-U", "postgres", "--auth=trust", "-E", "UTF8"],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(["pg_ctl", "-D", self.pg_data, "-w", "-l", os.path.join(self.workdir, "postgres.log"),
+                        "-o", f"-p {pg_port} -k {self.workdir} -c listen_addresses=127.0.0.1 "
+                              f"-c fsync=off -c max_connections=200", "start"],
+                       check=True, stdout=subprocess.DEVNULL)
+
+        self._spawn("s3", [sys.executable, "-m", "moto.server", "-H", "127.0.0.1", "-p", str(s3_port)])
+
+        wait_until(lambda: port_open(redis_port), 30, "redis-server")
+        wait_until(lambda: port_open(s3_port), 30, "moto server")
+
+        self.env = {
+            "REDIS_HOST": "127.0.0.1",
+            "REDIS_PORT": str(redis_port),
+            "PG_HOST": "127.0.0.1",
+            "PG_PORT": str(pg_port),
+            "POSTGRES_USER": "postgres",
+            "POSTGRES_DB": "postgres",
+            "GARAGE_S3_ENDPOINT": f"http://127.0.0.1:{s3_port}",
+            "GARAGE_S3_REGION": "us-east-1",
+            "AWS_ACCESS_KEY_ID": "bench",
+            "AWS_SECRET_ACCESS_KEY": "bench",
+        }
+        return self.env
+
+    def _spawn(self, name: str, command: List[str]):
+        log = open(os.path.join(self.workdir, f"{name}.log"), "wb")
+        self.processes.append(subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT))
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if os.path.exists(os.path.join(self.pg_data, "postmaster.pid")):
+            subprocess.run(["pg_ctl", "-D", self.pg_data, "-m", "immediate", "stop"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def process_tree(pid: int) -> List[int]:
+    """pid and all of its descendants (Linux /proc)"""
+    pids = [pid]
+    for current in pids:
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+def tree_rss(pid: int) -> int:
+    """Resident memory of a process tree in bytes"""
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+class RssSampler:
+    """Track the peak RSS of the app's process tree while a scenario runs"""
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "RssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self.peak = max(self.peak, tree_rss(self.pid))
+            if self._stop.wait(self.interval):
+                return
+
+class AppServer:
+    """The app under test, served by gunicorn exactly as in the container"""
+
+    def __init__(self, backend_env: Dict[str, str], workers: int, threads: int, workdir: str):
+        self.port = free_port()
+        self.env = dict(os.environ)
+        self.env.update(backend_env)
+        self.env.update({
+            "APP_PORT": str(self.port),
+            "SERVER_MODE": "gunicorn",
+            "WEB_WORKERS": str(workers),
+            "WEB_THREADS": str(threads),
+            "S3_BUCKET": backend_env.get("S3_BUCKET") or BENCH_BUCKET,
+            "PROMETHEUS_MULTIPROC_DIR": os.path.join(workdir, "metrics"),
+            # Background reconciles would add noise to the measurements
+            "METADATA_RECONCILE_INTERVAL": "0",
+            # Admission control off: every client gets a thread, so runs measure
+            # throughput rather than load shedding and compare with older commits
+            "HEALTH_RESERVED_THREADS": "0",
+            "UPLOAD_MAX_CONCURRENT": str(threads),
+            "UPLOAD_MAX_INFLIGHT_BYTES": "0",
+            "DOWNLOAD_MAX_CONCURRENT": str(threads),
+            "MAX_UPLOAD_BYTES": "0",
+        })
+        self.log_path = os.path.join(workdir, "app.log")
+        self.process = None
+
+    def start(self):
+        log = open(self.log_path, "wb")
+        self.process = subprocess.Popen([sys.executable, APP_PATH], env=self.env,
+                                        stdout=log, stderr=subprocess.STDOUT)
+        wait_until(lambda: self.get("/health/ready?fresh=1")[0] == 200, 60, "the app to become ready")
+        logger.info(f"App ready on port {self.port} (log: {self.log_path})")
+
+    def get(self, path: str):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def stop(self):
+        if self.process is not None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+def multipart_body(size: int, boundary: str, filename: str) -> Iterator[bytes]:
+    """Stream a multipart/form-data file field of size bytes without holding it in memory"""
+    yield (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+           f"Content-Type: application/octet-stream\r\n\r\n").encode()
+    # A unique prefix keeps every upload distinct, so no run is served from deduplicated data
+    prefix = uuid.uuid4().bytes
+    remaining = size
+    first = True
+    while remaining > 0:
+        block = BLOCK[:remaining]
+        if first:
+            block = (prefix + block)[:len(block)]
+            first = False
+        yield block
+        remaining -= len(block)
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+class Rejected(RuntimeError):
+    """The app shed the request (429/503 with Retry-After) instead of serving it"""
+
+def check_status(response: http.client.HTTPResponse, what: str, body: bytes = b""):
+    if response.status in (429, 503) and response.getheader("Retry-After") is not None:
+        raise Rejected(f"{what} rejected with {response.status}")
+    if response.status >= 400:
+        raise RuntimeError(f"{what} returned {response.status}: {body[:200]!r}")
+
+def upload(conn: http.client.HTTPConnection, size: int) -> Dict[str, Any]:
+    """POST one file of size bytes to /upload and return the response body"""
+    boundary = uuid.uuid4().hex
+    filename = f"bench-{size}.bin"
+    overhead = sum(len(part) for part in multipart_body(0, boundary, filename))
+    conn.request("POST", "/upload", body=multipart_body(size, boundary, filename), headers={
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Length": str(overhead + size)
+    })
+    response = conn.getresponse()
+    body = response.read()
+    check_status(response, "upload", body)
+    return json.loads(body)
+
+def fetch(conn: http.client.HTTPConnection, path: str) -> int:
+    """GET a path, discarding the body in chunks; returns the bytes received"""
+    conn.request("GET", path)
+    response = conn.getresponse()
+    received = 0
+    while True:
+        chunk = response.read(1024 * 1024)
+        if not chunk:
+            break
+        received += len(chunk)
+    check_status(response, f"GET {path}")
+    return received
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def run_load(port: int, operation: Callable[[http.client.HTTPConnection], int], concurrency: int,
+             duration: float, min_requests: int) -> Dict[str, Any]:
+    """Run operation from concurrency keep-alive clients for duration seconds
+
+    Every client completes at least min_requests requests, so slow scenarios
+    (large objects) still produce a sample.
+    """
+    deadline = time.monotonic() + duration
+    latencies: List[float] = []
+    transferred = [0]
+    errors = [0]
+    rejected = [0]
+    lock = threading.Lock()
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+        done = 0
+        while done < min_requests or time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                size = operation(conn)
+            except Rejected:
+                # Shed requests are counted apart and kept out of the latency samples
+                with lock:
+                    rejected[0] += 1
+            except Exception as e:
+                logger.debug(f"Request failed: {e}")
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+                with lock:
+                    errors[0] += 1
+            else:
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+                    transferred[0] += size
+            done += 1
+        conn.close()
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rejected": rejected[0],
+        "duration_s": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "throughput_bytes_per_s": round(transferred[0] / elapsed) if elapsed else 0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        }
+    }
+
+class BucketSeeder:
+    """Grow the bucket and the metadata index to a given number of objects"""
+
+    def __init__(self, env: Dict[str, str]):
+        import boto3
+        import psycopg2
+        from botocore.config import Config as BotoConfig
+
+        self.s3 = boto3.client(
+            "s3",
+            endpoint_url=env["GARAGE_S3_ENDPOINT"],
+            aws_access_key_id=env["AWS_ACCESS_KEY_ID"],
+            aws_secret_access_key=env["AWS_SECRET_ACCESS_KEY"],
+            region_name=env.get("GARAGE_S3_REGION", "us-east-1"),
+            config=BotoConfig(max_pool_connections=SEED_CONCURRENCY)
+        )
+        self.bucket = env.get("S3_BUCKET") or BENCH_BUCKET
+        self.conn = psycopg2.connect(host=env["PG_HOST"], port=int(env["PG_PORT"]),
+                                     user=env["POSTGRES_USER"], dbname=env["POSTGRES_DB"],
+                                     password=env.get("POSTGRES_PASSWORD") or None)
+        self.conn.autocommit = True
+        self.seeded = 0
+
+    def ensure_bucket(self):
+        try:
+            self.s3.head_bucket(Bucket=self.bucket)
+        except Exception:
+            self.s3.create_bucket(Bucket=self.bucket)
+
+    def count(self) -> int:
+        with self.conn.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM file_metadata;")
+            return cursor.fetchone()[0]
+
+    def grow_to(self, target: int):
+        """Add tiny objects (in S3 and in the index) until the listing holds target files"""
+        from psycopg2.extras import execute_values
+
+        missing = target - self.count()
+        if missing <= 0:
+            return
+        logger.info(f"Seeding {missing} objects (bucket size {target})")
+        now = datetime.now(timezone.utc)
+        rows = []
+        for n in range(missing):
+            key = f"{uuid.uuid4()}_seed-{self.seeded + n}.txt"
+            rows.append((key, f"seed-{self.seeded + n}.txt", 16, "text/plain",
+                         now - timedelta(seconds=self.seeded + n)))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SEED_CONCURRENCY) as executor:
+            list(executor.map(lambda row: self.s3.put_object(
+                Bucket=self.bucket, Key=row[0], Body=b"benchmark object", ContentType=row[3]), rows))
+        with self.conn.cursor() as cursor:
+            execute_values(cursor, """
+                INSERT INTO file_metadata (key, filename, size, content_type, uploaded_at)
+                VALUES %s ON CONFLICT (key) DO NOTHING;
+            """, rows, page_size=5000)
+        self.seeded += missing
+
+def run_benchmarks(args) -> Dict[str, Any]:
+    """Start everything, run each scenario over its matrix and collect the results"""
+    workdir = tempfile.mkdtemp(prefix="nixify-bench-")
+    backends = None
+    app_server = None
+    results = []
+    try:
+        if args.external_backends:
+            backend_env = {key: os.environ.get(key, default) for key, default in EXTERNAL_DEFAULTS.items()}
+            logger.warning("Using external backends: the benchmark writes objects and index rows to them")
+        else:
+            backends = Backends(workdir)
+            backend_env = backends.start()
+
+        seeder = BucketSeeder(backend_env)
+        seeder.ensure_bucket()
+
+        app_server = AppServer(backend_env, args.workers, args.threads, workdir)
+        app_server.start()
+        app_server.get("/api/files?limit=1")  # Creates the metadata schema
+
+        def measure(scenario: str, operation, concurrency: int, min_requests: int = 1, **labels):
+            logger.info(f"Running {scenario} x{concurrency} {labels}")
+            with RssSampler(app_server.process.pid) as sampler:
+                outcome = run_load(app_server.port, operation, concurrency, args.duration, min_requests)
+            outcome.update(scenario=scenario, concurrency=concurrency, peak_rss_bytes=sampler.peak, **labels)
+            results.append(outcome)
+            logger.info(f"  p50 {outcome['latency_ms']['p50']} ms, p99 {outcome['latency_ms']['p99']} ms, "
+                        f"{outcome['rps']} req/s, {outcome['errors']} errors, {outcome['rejected']} rejected")
+
+        scenarios = set(args.scenarios)
+        for concurrency in args.concurrency:
+            if "health" in scenarios:
+                measure("health", lambda conn: fetch(conn, "/health"), concurrency)
+
+        for size in args.object_sizes:
+            if "upload" in scenarios:
+                for concurrency in args.concurrency:
+                    measure("upload", lambda conn, size=size: upload(conn, size)["size"],
+                            concurrency, object_size=size)
+            if "download" in scenarios:
+                conn = http.client.HTTPConnection("127.0.0.1", app_server.port, timeout=600)
+                key = upload(conn, size)["key"]
+                conn.close()
+                for concurrency in args.concurrency:
+                    measure("download", lambda conn, key=key: fetch(conn, f"/file/{key}"),
+                            concurrency, object_size=size)
+
+        if "list" in scenarios:
+            for bucket_size in sorted(args.bucket_sizes):
+                seeder.grow_to(bucket_size)
+                for concurrency in args.concurrency:
+                    measure("list", lambda conn: fetch(conn, f"/api/files?limit={args.page_size}"),
+                            concurrency, bucket_size=bucket_size)
+    finally:
+        if app_server is not None:
+            app_server.stop()
+        if backends is not None:
+            backends.stop()
+        if args.keep_workdir:
+            logger.info(f"Logs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "workers": args.workers,
+            "threads": args.threads,
+            "duration_s": args.duration,
+            "external_backends": args.external_backends,
+        },
+        "results": results
+    }
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(APP_PATH), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def result_key(result: Dict[str, Any]) -> tuple:
+    return (result["scenario"], result["concurrency"], result.get("object_size"), result.get("bucket_size"))
+
+def describe(key: tuple) -> str:
+    scenario, concurrency, object_size, bucket_size = key
+    label = f"{scenario} x{concurrency}"
+    if object_size is not None:
+        label += f" {format_size(object_size)}"
+    if bucket_size is not None:
+        label += f" {bucket_size} objects"
+    return label
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> int:
+    """Print the change of every metric between two runs; non-zero if p95 or RPS regressed"""
+    before = {result_key(result): result for result in baseline["results"]}
+    regressions = 0
+    print(f"{'benchmark':<36} {'p50 ms':>18} {'p95 ms':>18} {'p99 ms':>18} {'req/s':>18} {'peak RSS MB':>18} "
+          f"{'rejected':>18}")
+    for result in current["results"]:
+        key = result_key(result)
+        old = before.get(key)
+        if old is None:
+            print(f"{describe(key):<36} (no baseline)")
+            continue
+
+        cells = []
+        for name, new_value, old_value in (
+            ("p50", result["latency_ms"]["p50"], old["latency_ms"]["p50"]),
+            ("p95", result["latency_ms"]["p95"], old["latency_ms"]["p95"]),
+            ("p99", result["latency_ms"]["p99"], old["latency_ms"]["p99"]),
+            ("rps", result["rps"], old["rps"]),
+            ("rss", result["peak_rss_bytes"] / 2 ** 20, old["peak_rss_bytes"] / 2 ** 20),
+        ):
+            change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+            cells.append(f"{new_value:>9.1f} {change:>+7.1f}%")
+            if (name == "p95" and change > threshold) or (name == "rps" and change < -threshold):
+                regressions += 1
+        # Runs recorded before rejections were counted apart have no such field
+        cells.append(f"{result.get('rejected', 0):>9} {'(' + str(old.get('rejected', 0)) + ')':>8}")
+        print(f"{describe(key):<36} " + " ".join(cells))
+
+    if regressions:
+        print(f"\n{regressions} regression(s) beyond {threshold}% (p95 latency or req/s)")
+        return 1
+    return 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Run the benchmarks and write the results as JSON")
+    run.add_argument("--scenarios", default="health,upload,download,list",
+                     type=lambda value: value.split(","), help="Scenarios to run")
+    run.add_argument("--concurrency", default="1,8,32",
+                     type=lambda value: [int(n) for n in value.split(",")], help="Concurrent clients")
+    run.add_argument("--object-sizes", default="1KB,1MB,16MB",
+                     type=lambda value: [parse_size(n) for n in value.split(",")],
+                     help="Upload/download object sizes, e.g. 1KB,1MB,1GB")
+    run.add_argument("--bucket-sizes", default="10,1000,10k",
+                     type=lambda value: [parse_count(n) for n in value.split(",")],
+                     help="Objects in the bucket for the listing benchmark, e.g. 10,1k,100k")
+    run.add_argument("--page-size", type=int, default=100, help="Listing page size")
+    run.add_argument("--duration", type=float, default=10, help="Seconds per benchmark")
+    run.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    run.add_argument("--threads", type=int, default=8, help="Threads per gunicorn worker")
+    run.add_argument("--external-backends", action="store_true",
+                     help="Use the backends configured in the environment instead of starting local ones")
+    run.add_argument("--keep-workdir", action="store_true", help="Keep logs and data of the run")
+    run.add_argument("--output", default="-", help="Result file (default: stdout)")
+
+    diff = commands.add_parser("compare", help="Compare two result files")
+    diff.add_argument("baseline")
+    diff.add_argument("current")
+    diff.add_argument("--threshold", type=float, default=10, help="Allowed regression in percent")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        return compare(baseline, current, args.threshold)
+
+    report = json.dumps(run_benchmarks(args), indent=2)
+    if args.output == "-":
+        print(report)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+        logger.info(f"Results written to {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -50,6 +50,10 @@ EOF
     boto3
     werkzeug
     jinja2
+    pillow
+    gunicorn
+    prometheus-client
+    zstandard
   ]);
 
   # PostgreSQL configuration files
@@ -16,6 +16,27 @@
         docker-image = pkgs.callPackage ./docker-redis-postgres-minimal.nix {};
       };
 
+      # Local backends and Python packages for running the app and the benchmarks
+      devShells.${system}.default = pkgs.mkShell {
+        packages = [
+          pkgs.redis
+          pkgs.postgresql
+          (pkgs.python3.withPackages (ps: with ps; [
+            flask
+            psycopg2
+            redis
+            boto3
+            werkzeug
+            jinja2
+            pillow
+            gunicorn
+            prometheus-client
+            zstandard
+            moto
+            flask-cors
+          ]))
+        ];
+      };
 
     };
 }